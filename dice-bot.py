@@ -7,4 +7,4 @@ from dicebot import main
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    main(os.environ['DB'])
+    main(os.environ['DB'], os.environ.get('DB_REPLICA'))
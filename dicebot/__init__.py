@@ -11,10 +11,11 @@ Multiple commands can be invoked in one message in this way
 '''
 
 import copy
-import re
+import time
 import asyncio
+import logging
 from collections import OrderedDict
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 import discord
 from discord.ext import commands
@@ -24,27 +25,38 @@ from sqlalchemy.exc import IntegrityError
 from equations import EquationError
 
 from . import model as m
-from .cogs import util
-
+from . import search
+from . import notify
+from . import rng
+from . import changes
+from . import history
+from . import stats
+from . import metrics
+from . import dispatch
+from . import archive
+from . import clock
+from .cogs import util, debug, rolls
+
+logger = logging.getLogger(__name__)
 
 default_prefix = ';'
 
 
+def server_prefix(guild):
+    if guild:
+        return dispatch.prefixes.get(str(guild.id), default_prefix)
+    return default_prefix
+
+
 async def get_prefix(bot: commands.Bot, message: discord.Message):
-    if message.guild:
-        with closing(bot.Session()) as session:
-            item = session.query(m.Prefix).get(str(message.guild.id))
-            prefix = default_prefix if item is None else item.prefix
-    else:
-        prefix = default_prefix
-    return prefix
+    return server_prefix(message.guild)
 
 
 bot = commands.Bot(
     command_prefix=get_prefix,
     description=__doc__,
     loop=asyncio.new_event_loop())
-delete_emoji = '❌'
+delete_emoji = util.delete_emoji
 
 
 @bot.event
@@ -62,12 +74,31 @@ async def on_ready():
     await bot.change_presence(activity=discord.Game(name=game))
 
 
+# seconds after a user runs a command that changes something during which their reads still go to the primary
+replica_lag = 10
+
+# users who recently ran a command that may have changed something
+recent_writers = util.ExpiringSet(10000, replica_lag)
+
+
 @bot.before_invoke
 async def before_any_command(ctx):
     '''
     Set up database connection
+    Read only commands use the read replica unless the user may not see their own changes there yet
+    Archived servers are restored first
     '''
-    ctx.session = bot.Session()
+    metrics.command_started(ctx)
+    if ctx.guild is not None:
+        archive.activity.touch(ctx.guild.id)
+        if archive.restore_if_archived(bot.Session, ctx.guild.id):
+            # the replica may not have the restored rows yet
+            recent_writers.add(ctx.author.id)
+    debug.command_started(ctx)
+    if util.is_read_only(ctx.command) and ctx.author.id not in recent_writers:
+        ctx.session = bot.ReplicaSession()
+    else:
+        ctx.session = bot.Session()
 
 
 @bot.after_invoke
@@ -77,37 +108,45 @@ async def after_any_command(ctx):
     '''
     ctx.session.close()
     ctx.session = None
+    if not util.is_read_only(ctx.command):
+        recent_writers.add(ctx.author.id)
+    debug.command_finished(ctx)
+    metrics.command_finished(ctx)
 
 
 @bot.event
 async def on_message(message):
+    if dispatch.mention is None:
+        dispatch.set_user(bot.user)
+    prefix = server_prefix(message.guild)
+    if not dispatch.candidate(message, prefix):
+        return
+
     ctx = await bot.get_context(message)
-    with closing(bot.Session()) as session:
-        blacklisted = session.query(m.Blacklist).get(ctx.author.id)
-    if blacklisted:
+    if message.author.id in dispatch.blacklist:
+        dispatch.counts['blacklisted'] += 1
         await on_command_error(ctx, Exception('User does not have permission for this command'))
     elif ctx.valid:
+        dispatch.counts['dispatched'] += 1
         await bot.invoke(ctx)
     else:
-        mention = message.guild.get_member(bot.user.id).mention if message.guild else bot.user.mention
-        expr = re.compile(r'{}\s*(.*)(?=\n|$)'.format(re.escape(mention)))
-        prefix = await get_prefix(bot, message)
-        for command in expr.findall(message.content):
+        for command in dispatch.mention.findall(message.content):
+            dispatch.counts['dispatched'] += 1
             m2 = copy.copy(message)
             m2.content = prefix + command
             await bot.process_commands(m2)
 
 
-def is_my_delete_emoji(reaction):
-    return reaction.me and reaction.count > 1 and str(reaction.emoji) == delete_emoji
-
-
 @bot.event
 async def on_raw_reaction_add(payload):
-    if payload.user_id != bot.user.id and str(payload.emoji) == delete_emoji:
-        message = await bot.get_channel(payload.channel_id).get_message(payload.message_id)
-        if discord.utils.find(is_my_delete_emoji, message.reactions):
-            await message.delete()
+    if payload.message_id not in util.deletable or str(payload.emoji) != delete_emoji:
+        return
+    if payload.user_id != bot.user.id:
+        util.deletable.discard(payload.message_id)
+        try:
+            await bot.http.delete_message(payload.channel_id, payload.message_id)
+        except discord.NotFound:
+            pass
 
 
 @bot.event
@@ -141,6 +180,8 @@ async def on_command_error(ctx, error: Exception):
             message = "Couldn't find requested item: `{}`".format(error.value)
         else:
             message = "Couldn't find requested item"
+        if error.suggestions:
+            message += '\nDid you mean: {}?'.format(', '.join('`{}`'.format(s) for s in error.suggestions))
     elif isinstance(error, EquationError):
         if error.args:
             message = 'Invalid dice expression: {}'.format(error.args[0])
@@ -160,7 +201,7 @@ async def on_command_error(ctx, error: Exception):
     message += '\n(click {} below to delete this message)'.format(delete_emoji)
     embed = discord.Embed(description=message, color=discord.Color.red())
     msg = await ctx.send(embed=embed)
-    await msg.add_reaction(delete_emoji)
+    await util.make_deletable(msg)
 
     if unknown:
         raise error
@@ -182,14 +223,17 @@ async def setprefix(ctx, prefix: str = default_prefix):
     '''
     guild_id = str(ctx.guild.id)
     item = ctx.session.query(m.Prefix).get(guild_id)
+    previous = None if item is None else item.prefix
     if prefix == default_prefix:
         if item is not None:
             ctx.session.delete(item)
+        changes.record(ctx.session, m.Prefix.__tablename__, guild_id, previous, None)
     else:
         if item is None:
             item = m.Prefix(server=guild_id)
             ctx.session.add(item)
         item.prefix = prefix
+        changes.record(ctx.session, m.Prefix.__tablename__, guild_id, previous, prefix)
     try:
         ctx.session.commit()
     except IntegrityError:
@@ -200,26 +244,52 @@ async def setprefix(ctx, prefix: str = default_prefix):
 
 
 @bot.command(ignore_extra=False)
+@commands.has_permissions(administrator=True)
+async def setrandom(ctx, source: str = 'default'):
+    '''
+    Sets the source of random numbers for dice and tables on the server
+    Can only be done by an administrator
+
+    Parameters:
+    [source] the new source of random numbers, can be default|secure
+        default: a fast pseudorandom generator
+        secure: the operating system's cryptographically secure generator
+    '''
+    if source not in rng.sources:
+        raise commands.BadArgument('Bad argument: source')
+    guild_id = str(ctx.guild.id)
+    item = ctx.session.query(m.RandomSource).get(guild_id)
+    previous = None if item is None else item.source
+    if source == 'default':
+        if item is not None:
+            ctx.session.delete(item)
+        changes.record(ctx.session, m.RandomSource.__tablename__, guild_id, previous, None)
+    else:
+        if item is None:
+            item = m.RandomSource(server=guild_id)
+            ctx.session.add(item)
+        item.source = source
+        changes.record(ctx.session, m.RandomSource.__tablename__, guild_id, previous, source)
+    ctx.session.commit()
+    await util.send_embed(ctx, author=False, description='Random source changed to `{}`'.format(source))
+
+
+@bot.command(ignore_extra=False)
+@util.read_only
 async def checkprefix(ctx):
     '''
     Echoes the prefix the bot is currently set to respond to in this server
     '''
-    if ctx.guild:
-        with closing(bot.Session()) as session:
-            item = session.query(m.Prefix).get(str(ctx.guild.id))
-            prefix = default_prefix if item is None else item.prefix
-    else:
-        prefix = default_prefix
+    prefix = server_prefix(ctx.guild)
 
     message = 'Current prefix = `{}`'.format(prefix)
     message += '\n(click {} below to delete this message)'.format(delete_emoji)
     embed = discord.Embed(description=message, color=ctx.guild.get_member(ctx.bot.user.id).color)
     msg = await ctx.send(embed=embed)
-    await msg.add_reaction(delete_emoji)
+    await util.make_deletable(msg)
 
 
-prefix = __name__ + '.cogs.'
-for extension in [
+extensions = [
     'characters',
     'rolls',
     'resources',
@@ -229,37 +299,113 @@ for extension in [
     'information',
     'timers',
     'tables',
-]:
-    bot.load_extension(prefix + extension)
+    'initiative',
+    'debug',
+]
+
+
+def load_extensions():
+    '''
+    Loads the command categories
+    '''
+    prefix = __name__ + '.cogs.'
+    for extension in extensions:
+        bot.load_extension(prefix + extension)
 
 
 # ----#-
 
 
-def main(database: str):
+@contextmanager
+def phase(name):
+    '''
+    Logs how long a step of starting the bot takes
+    '''
+    start = time.perf_counter()
+    yield
+    logger.info('Startup: %s took %.3f seconds', name, time.perf_counter() - start)
+
+
+def setup_database(engine):
+    '''
+    Creates missing tables, columns and search indexes, but only if the schema changed since the last start
+    Also compiles rolls saved before rolls were compiled
+    Returns whether the schema changed
+    '''
+    # the data migrations are part of the version so databases set up before them run them once
+    version = m.schema_version(*search.sqlite_statements, *search.postgresql_statements, 'compile saved rolls')
+    if m.stored_schema_version(engine) == version:
+        search.setup(engine, create=False)
+        return False
+    m.Base.metadata.create_all(engine)
+    m.add_missing_columns(engine)
+    search.setup(engine)
+    with closing(sessionmaker(bind=engine)()) as session:
+        compiled = rolls.compile_saved(session)
+    if compiled:
+        logger.info('Compiled %d saved rolls', compiled)
+    m.store_schema_version(engine, version)
+    return True
+
+
+def load_config(Session):
+    '''
+    Loads the stored config values in one query and stores the defaults of missing keys
+    '''
+    with closing(Session()) as session:
+        stored = session.query(m.Config.name, m.Config.value)\
+            .filter(m.Config.name.in_(list(bot.config))).all()
+        missing = set(bot.config) - {name for name, value in stored}
+        bot.config.update(stored)
+        if missing:
+            session.add_all([m.Config(name=name, value=bot.config[name]) for name in missing])
+            session.commit()
+
+
+def main(database: str, replica: str = None):
+    '''
+    Runs the bot
+    [database] the url of the database
+    [replica] (optional) the url of a read replica of the database for read only commands
+    '''
+    started = time.perf_counter()
     bot.config = OrderedDict([
         ('token', None),
         ('url', None),
+        ('history_days', '90'),
+        ('metrics_port', None),
+        ('archive_days', '365'),
     ])
 
-    engine = create_engine(database)
-    m.Base.metadata.create_all(engine)
-    bot.Session = sessionmaker(bind=engine)
-    with closing(bot.Session()) as session:
-        for name in bot.config:
-            key = session.query(m.Config).get(name)
-            if key is not None:
-                bot.config[name] = key.value
-            else:
-                key = m.Config(name=name, value=bot.config[name])
-                session.add(key)
-                session.commit()
-
-            if False:
-                arg = input('[{}] (default: {}): '.format(name, repr(key.value)))
-                if arg:
-                    key.value = arg
-                    bot.config[name] = arg
-                    session.commit()
-
+    with phase('database setup'):
+        engine = create_engine(database)
+        if setup_database(engine):
+            logger.info('Schema changed, created missing tables, columns and search indexes')
+        bot.Session = sessionmaker(bind=engine)
+        if replica:
+            replica_engine = create_engine(replica)
+            if replica_engine.dialect.name == 'sqlite':
+                # a local copy for testing, real replicas are read only and get the schema from the primary
+                setup_database(replica_engine)
+            bot.ReplicaSession = sessionmaker(bind=replica_engine)
+        else:
+            bot.ReplicaSession = bot.Session
+    with phase('config'):
+        load_config(bot.Session)
+    with phase('caches'):
+        notify.setup(engine, bot.loop)
+        rng.load(bot.Session)
+        dispatch.load(bot.Session)
+        archive.load(bot.Session)
+    with phase('extensions'):
+        load_extensions()
+
+    bot.loop.create_task(history.log.run(bot.Session, retention=int(bot.config['history_days'])))
+    bot.loop.create_task(stats.tally.run(bot.Session))
+    bot.loop.create_task(dispatch.refresh())
+    bot.loop.create_task(archive.run(bot.Session, inactive_days=int(bot.config['archive_days'])))
+    bot.loop.create_task(clock.run(bot, bot.Session))
+    if bot.config['metrics_port']:
+        metrics.setup(bot, engine, int(bot.config['metrics_port']))
+    logger.info('Startup: ready to connect after %.3f seconds', time.perf_counter() - started)
     bot.run(bot.config['token'])
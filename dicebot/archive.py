@@ -0,0 +1,320 @@
+'''
+Moves the data of servers that stopped using the bot out of the tables every command reads
+
+Commands mark their server as used, the times are written to server_activity at most once an hour per server
+A background task archives servers that have not used the bot for longer than the threshold:
+their characters with all of their attributes, roll history and statistics, and their encounters
+are stored as one compressed JSON blob in server_archives and deleted from their tables
+The first command on an archived server restores its rows before the command runs
+Restored rows get new ids, the references between them are updated to match
+'''
+
+import json
+import time
+import zlib
+import asyncio
+import logging
+import datetime
+from contextlib import closing
+
+from sqlalchemy import Enum, DateTime, and_, or_, select
+
+from . import model as m
+from . import changes
+from . import history
+from . import stats
+
+logger = logging.getLogger(__name__)
+
+time_format = '%Y-%m-%d %H:%M:%S.%f'
+
+characters = m.Character.__table__
+encounters = m.Encounter.__table__
+combatants = m.Combatant.__table__
+
+# the tables with rows keyed by character id
+character_tables = [
+    relationship.mapper.local_table
+    for relationship in m.Character.__mapper__.relationships
+] + [m.RollStats.__table__, m.RollRecord.__table__]
+
+# servers that have an archive
+archived = set()
+
+session_factory = None
+
+
+class Activity:
+    '''
+    Remembers when servers used the bot until the times are written
+    '''
+    def __init__(self, interval=3600):
+        # seconds before a server's activity is written again
+        self.interval = interval
+        # the monotonic time each server's activity was last queued
+        self.queued = {}
+        self.pending = {}
+
+    def touch(self, server):
+        server = str(server)
+        now = time.monotonic()
+        queued = self.queued.get(server)
+        if queued is None or now - queued >= self.interval:
+            self.queued[server] = now
+            self.pending[server] = datetime.datetime.utcnow()
+
+    def flush(self, session):
+        '''
+        Writes the queued activity times
+        '''
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = {}
+        try:
+            for server, last_used in pending.items():
+                session.merge(m.ServerActivity(server=server, last_used=last_used))
+            session.commit()
+        except Exception:
+            session.rollback()
+            # newer times queued in the meantime win
+            pending.update(self.pending)
+            self.pending = pending
+            raise
+
+
+activity = Activity()
+
+
+def dump_row(table, row):
+    '''
+    Converts a row to JSON compatible values by column name
+    '''
+    values = {}
+    for column in table.c:
+        value = row[column]
+        if isinstance(column.type, Enum) and value is not None:
+            value = value.name
+        elif isinstance(column.type, DateTime) and value is not None:
+            value = value.strftime(time_format)
+        values[column.name] = value
+    return values
+
+
+def load_row(table, values):
+    '''
+    Converts dumped values back to a row
+    Columns added after the archive was made are left out so they get their defaults
+    '''
+    row = {}
+    for column in table.c:
+        if column.name not in values:
+            continue
+        value = values[column.name]
+        if isinstance(column.type, Enum) and value is not None:
+            value = column.type.enum_class[value]
+        elif isinstance(column.type, DateTime) and value is not None:
+            value = datetime.datetime.strptime(value, time_format)
+        row[column.key] = value
+    return row
+
+
+def selections(server):
+    '''
+    Gets the conditions that select each archived table's rows for a server, parents first
+    '''
+    character_ids = select([characters.c.id]).where(characters.c.server == server)
+    encounter_ids = select([encounters.c.id]).where(encounters.c.server == server)
+    return [(characters, characters.c.server == server)] + [
+        (table, table.c.character_id.in_(character_ids))
+        for table in character_tables
+    ] + [
+        (encounters, encounters.c.server == server),
+        (combatants, or_(combatants.c.encounter_id.in_(encounter_ids), combatants.c.character_id.in_(character_ids))),
+    ]
+
+
+def archive(session, server):
+    '''
+    Moves a server's rows into an archive and commits
+    Returns the number of rows archived
+    '''
+    # write buffered rolls and statistics first so they are archived, not written after the rows are gone
+    history.log.flush(session)
+    stats.tally.flush(session)
+    parts = selections(server)
+    data = {}
+    for table, condition in parts:
+        rows = [dump_row(table, row) for row in session.execute(select([table]).where(condition))]
+        if rows:
+            data[table.name] = rows
+
+    if data:
+        for table, condition in reversed(parts):
+            session.execute(table.delete().where(condition))
+        session.add(m.ServerArchive(
+            server=server,
+            archived=datetime.datetime.utcnow(),
+            data=zlib.compress(json.dumps(data).encode(), 9)))
+        changes.record(session, m.ServerArchive.__tablename__, server, new=server)
+    else:
+        # nothing to archive, stop tracking the server until it comes back
+        session.query(m.ServerActivity).filter_by(server=server).delete(synchronize_session=False)
+    session.commit()
+    return sum(len(rows) for rows in data.values())
+
+
+def insert(session, table, row):
+    return session.execute(table.insert().values(row)).inserted_primary_key[0]
+
+
+def restore(session, server):
+    '''
+    Moves a server's rows from its archive back into their tables and commits
+    Returns whether there was an archive
+    '''
+    saved = session.query(m.ServerArchive).with_for_update().get(server)
+    if saved is None:
+        session.rollback()
+        return False
+    data = json.loads(zlib.decompress(saved.data).decode())
+
+    # new ids by old id
+    character_ids = {}
+    for values in data.get(characters.name, []):
+        row = load_row(characters, values)
+        old = row.pop('id')
+        character_ids[old] = insert(session, characters, row)
+
+    for table in character_tables:
+        rows = [load_row(table, values) for values in data.get(table.name, [])]
+        for row in rows:
+            if 'id' in table.c:
+                del row['id']
+            row['character_id'] = character_ids[row['character_id']]
+        if rows:
+            session.execute(table.insert(), rows)
+
+    encounter_ids = {}
+    turns = {}
+    for values in data.get(encounters.name, []):
+        row = load_row(encounters, values)
+        old = row.pop('id')
+        # the turn is the id of a combatant, set once the combatants have their new ids
+        turns[old] = row.pop('turn')
+        encounter_ids[old] = insert(session, encounters, row)
+
+    combatant_ids = {}
+    for values in data.get(combatants.name, []):
+        row = load_row(combatants, values)
+        old = row.pop('id')
+        row['encounter_id'] = encounter_ids.get(row['encounter_id'], row['encounter_id'])
+        if row['character_id'] is not None:
+            row['character_id'] = character_ids.get(row['character_id'], row['character_id'])
+        combatant_ids[old] = insert(session, combatants, row)
+
+    for old, turn in turns.items():
+        if turn is not None:
+            session.execute(encounters.update()
+                            .where(encounters.c.id == encounter_ids[old])
+                            .values(turn=combatant_ids.get(turn)))
+
+    session.delete(saved)
+    changes.record(session, m.ServerArchive.__tablename__, server, old=server)
+    session.commit()
+    return True
+
+
+def restore_if_archived(Session, server):
+    '''
+    Restores a server if it has an archive
+    Returns whether it was restored
+    '''
+    server = str(server)
+    if server not in archived:
+        return False
+    with closing(Session()) as session:
+        restored = restore(session, server)
+    archived.discard(server)
+    if restored:
+        logger.info('Restored server %s', server)
+    return restored
+
+
+def inactive(session, days, limit):
+    '''
+    Gets servers that have not used the bot for a number of days and are not archived
+    Servers that have rows but no recorded activity start being tracked from now
+    '''
+    archives = select([m.ServerArchive.server])
+    tracked = select([m.ServerActivity.server])
+    untracked = session.execute(
+        select([characters.c.server]).where(and_(
+            characters.c.server.notin_(tracked),
+            characters.c.server.notin_(archives))).distinct()).fetchall()
+    if untracked:
+        now = datetime.datetime.utcnow()
+        session.execute(m.ServerActivity.__table__.insert(), [
+            {'server': server, 'last_used': now} for server, in untracked])
+        session.commit()
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    servers = session.query(m.ServerActivity.server)\
+        .filter(m.ServerActivity.last_used < cutoff)\
+        .filter(m.ServerActivity.server.notin_(archives))\
+        .limit(limit).all()
+    # used since the activity was last written
+    return [server for server, in servers if server not in activity.pending]
+
+
+def load(Session):
+    '''
+    Loads which servers are archived
+    [Session] the session factory, kept to reload them after a reset
+    '''
+    global session_factory
+    session_factory = Session
+    with closing(Session()) as session:
+        servers = {server for server, in session.query(m.ServerArchive.server)}
+    archived.clear()
+    archived.update(servers)
+
+
+async def run(Session, interval=60, inactive_days=365, archive_every=3600, limit=10):
+    '''
+    Writes server activity every interval seconds
+    Archives up to limit servers that have been inactive for inactive_days every archive_every seconds
+    '''
+    elapsed = 0
+    while True:
+        await asyncio.sleep(interval)
+        elapsed += interval
+        try:
+            with closing(Session()) as session:
+                activity.flush(session)
+                if elapsed >= archive_every:
+                    elapsed = 0
+                    for server in inactive(session, inactive_days, limit):
+                        count = archive(session, server)
+                        if count:
+                            logger.info('Archived server %s: %d rows', server, count)
+                        # let commands run between servers
+                        await asyncio.sleep(0)
+        except Exception:
+            logger.exception('Could not archive servers')
+
+
+@changes.subscribe
+def apply(committed):
+    for change in committed:
+        if change.table == m.ServerArchive.__tablename__:
+            if change.new is None:
+                archived.discard(change.key)
+            else:
+                archived.add(change.key)
+
+
+@changes.on_reset
+def reset():
+    if session_factory is not None:
+        load(session_factory)
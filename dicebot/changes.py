@@ -0,0 +1,126 @@
+'''
+Tracks changes to characters and their attributes so in-memory caches can follow them
+
+Changes made through the ORM are picked up when the session flushes,
+statements that bypass the ORM should call `record` themselves
+Before a session commits, the version of every changed character is incremented
+Subscribers are called with the list of changes once the session commits
+'''
+
+from collections import namedtuple
+
+from sqlalchemy import event, inspect, update
+from sqlalchemy.orm import Session
+
+from . import model as m
+
+Change = namedtuple('Change', ['table', 'key', 'old', 'new'])
+Change.__doc__ = '''
+A change to a character or one of its attributes
+[table] the name of the changed table
+[key] the id of the character, or the primary key for tables unrelated to characters
+[old] the name before the change, None if the row was created
+[new] the name after the change, None if the row was deleted
+'''
+
+subscribers = []
+resetters = []
+
+
+def subscribe(callback):
+    '''
+    Registers a callback to receive the list of changes after every commit
+    '''
+    subscribers.append(callback)
+    return callback
+
+
+def on_reset(callback):
+    '''
+    Registers a callback to discard cached state when changes may have been missed
+    '''
+    resetters.append(callback)
+    return callback
+
+
+def record(session, table, key, old=None, new=None):
+    '''
+    Records a change that will be published when the session commits
+    '''
+    session.info.setdefault('changes', []).append(Change(table, key, old, new))
+
+
+def publish(changes):
+    '''
+    Passes a list of changes to all subscribers
+    '''
+    for callback in subscribers:
+        callback(changes)
+
+
+def reset():
+    '''
+    Tells all caches to discard their state
+    '''
+    for callback in resetters:
+        callback()
+
+
+# the tables of the attributes listed on a character
+attribute_tables = {
+    relationship.mapper.local_table.name
+    for relationship in m.Character.__mapper__.relationships
+}
+
+# the tables whose changes are keyed by character id
+character_tables = attribute_tables | {m.Character.__tablename__}
+
+
+def is_attribute(obj):
+    '''
+    Whether an object is a named attribute of a character
+    '''
+    return isinstance(obj, m.Base) and obj.__tablename__ in attribute_tables
+
+
+@event.listens_for(Session, 'after_flush')
+def after_flush(session, flush_context):
+    for obj in filter(is_attribute, session.new):
+        record(session, obj.__tablename__, obj.character_id, new=obj.name)
+    for obj in filter(is_attribute, session.deleted):
+        record(session, obj.__tablename__, obj.character_id, old=obj.name)
+    for obj in session.dirty:
+        if is_attribute(obj) and session.is_modified(obj):
+            history = inspect(obj).attrs.name.history
+            if history.deleted and history.added:
+                record(session, obj.__tablename__, obj.character_id, old=history.deleted[0], new=history.added[0])
+            else:
+                record(session, obj.__tablename__, obj.character_id, old=obj.name, new=obj.name)
+        elif isinstance(obj, m.Character) and session.is_modified(obj):
+            history = inspect(obj).attrs.name.history
+            old = history.deleted[0] if history.deleted else obj.name
+            record(session, obj.__tablename__, obj.id, old=old, new=obj.name)
+
+
+@event.listens_for(Session, 'before_commit')
+def before_commit(session):
+    session.flush()
+    changes = session.info.get('changes')
+    if changes:
+        ids = {change.key for change in changes if change.table in character_tables}
+        if ids:
+            session.execute(update(m.Character.__table__)
+                            .where(m.Character.id.in_(ids))
+                            .values(version=m.Character.version + 1))
+
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session):
+    changes = session.info.pop('changes', None)
+    if changes:
+        publish(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('changes', None)
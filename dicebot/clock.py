@@ -0,0 +1,253 @@
+'''
+Timers that run out on the clock
+
+`timer run` gives a timer the time it runs out and the channel to tell
+A single task advances a hierarchical timer wheel once a second,
+so a running timer costs nothing until it runs out, however many there are
+Timers that run out in the same second are written in one transaction and announced with one message per channel
+The wheel is rebuilt from the database once the bot is connected,
+and the timers of servers restored from the archive are scheduled when they are restored
+'''
+
+import math
+import time
+import asyncio
+import logging
+import datetime
+from contextlib import closing
+
+import discord
+from discord.ext import commands
+from sqlalchemy import and_, select
+
+from . import model as m
+from . import changes
+
+logger = logging.getLogger(__name__)
+
+epoch = datetime.datetime(1970, 1, 1)
+
+# seconds before timers that could not be written are tried again
+retry_delay = 5
+
+session_factory = None
+client = None
+
+
+class TimerWheel:
+    '''
+    Schedules keys to come due on a tick
+    Level n has 64 slots that each cover 64**n ticks,
+    keys on higher levels move down when the tick reaches the start of their slot
+    Scheduling a key and advancing a tick take constant time
+    '''
+    bits = 6
+    size = 1 << bits
+    levels = 5
+
+    def __init__(self, tick=0):
+        # the last tick that was advanced to
+        self.tick = tick
+        self.wheels = [[[] for _ in range(self.size)] for _ in range(self.levels)]
+        # the tick each key is due on, keys scheduled again leave their old entry behind to be skipped
+        self.scheduled = {}
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def schedule(self, key, tick):
+        '''
+        Schedules a key to come due on a tick, replacing its previous tick
+        Keys due in the past come due on the next tick
+        '''
+        tick = max(tick, self.tick + 1)
+        if tick - self.tick >= self.size ** self.levels:
+            raise ValueError('Too far in the future')
+        self.scheduled[key] = tick
+        self.place(key, tick)
+
+    def cancel(self, key):
+        self.scheduled.pop(key, None)
+
+    def place(self, key, tick):
+        delta = tick - self.tick
+        for level in range(self.levels):
+            if delta < self.size ** (level + 1):
+                slot = (tick >> (self.bits * level)) & (self.size - 1)
+                self.wheels[level][slot].append((tick, key))
+                return
+
+    def advance(self):
+        '''
+        Moves to the next tick
+        Returns the keys that came due
+        '''
+        self.tick += 1
+        for level in range(1, self.levels):
+            if self.tick & ((1 << (self.bits * level)) - 1):
+                break
+            # the start of a slot on this level, move its keys down
+            slot = (self.tick >> (self.bits * level)) & (self.size - 1)
+            entries = self.wheels[level][slot]
+            self.wheels[level][slot] = []
+            for tick, key in entries:
+                self.place(key, tick)
+
+        slot = self.tick & (self.size - 1)
+        entries = self.wheels[0][slot]
+        self.wheels[0][slot] = []
+        due = []
+        for tick, key in entries:
+            if self.scheduled.get(key) == tick:
+                del self.scheduled[key]
+                due.append(key)
+        return due
+
+
+wheel = TimerWheel(int(time.time()))
+
+
+def to_tick(when):
+    '''
+    Converts a UTC datetime to a tick of the wheel, rounding up so the time has passed by the tick
+    '''
+    return math.ceil((when - epoch).total_seconds())
+
+
+def schedule(timer_id, expires):
+    '''
+    Schedules a timer to run out at a UTC datetime
+    '''
+    wheel.schedule(timer_id, to_tick(expires))
+
+
+def running(session, server=None):
+    '''
+    Gets the id, run out time and channel of the timers running on the clock
+    [server] (optional) only get the timers of characters on this server
+    '''
+    query = session.query(m.Timer.id, m.Timer.expires, m.Timer.channel)\
+        .filter(m.Timer.expires.isnot(None))
+    if server is not None:
+        query = query.join(m.Character, m.Timer.character_id == m.Character.id)\
+            .filter(m.Character.server == server)
+    return query.all()
+
+
+def schedule_visible(bot, timers):
+    '''
+    Schedules the timers in the channels the bot can see
+    '''
+    for timer_id, expires, channel in timers:
+        if channel is not None and bot.get_channel(int(channel)) is not None:
+            schedule(timer_id, expires)
+
+
+def load(Session, bot):
+    '''
+    Schedules the running timers in the channels the bot can see
+    [Session] the session factory, kept to schedule the timers of restored servers
+    '''
+    global session_factory, client
+    session_factory = Session
+    client = bot
+    with closing(Session()) as session:
+        timers = running(session)
+    schedule_visible(bot, timers)
+    logger.info('Scheduled %d running timers', len(wheel))
+
+
+def expire(session, ids):
+    '''
+    Stops timers that ran out and commits
+    Only timers whose time in the database has passed are stopped, not ones that were restarted or stopped since
+    Returns the id, name, character and channel of each stopped timer
+    '''
+    table = m.Timer.__table__
+    where = and_(table.c.id.in_(ids), table.c.expires <= datetime.datetime.utcnow())
+    update = table.update().values({table.c.value: 0, table.c.expires: None})
+    columns = [table.c.id, table.c.name, table.c.character_id, table.c.channel]
+    if session.bind.dialect.implicit_returning:
+        rows = session.execute(update.where(where).returning(*columns)).fetchall()
+    else:
+        # without RETURNING, read the rows in the same transaction that changes them
+        rows = session.execute(select(columns).where(where)).fetchall()
+        if rows:
+            session.execute(update.where(table.c.id.in_([row.id for row in rows])))
+    for row in rows:
+        changes.record(session, table.name, row.character_id)
+    session.commit()
+    return rows
+
+
+async def announce(bot, session, rows):
+    '''
+    Sends one message to each channel about the timers in it that ran out
+    '''
+    characters = dict(
+        (id, (name, user)) for id, name, user in session.query(m.Character.id, m.Character.name, m.Character.user)
+        .filter(m.Character.id.in_({row.character_id for row in rows})))
+    channels = {}
+    for row in rows:
+        channels.setdefault(row.channel, []).append(row)
+    for channel_id, expired in channels.items():
+        channel = bot.get_channel(int(channel_id))
+        if channel is None:
+            continue
+        paginator = commands.Paginator(prefix='', suffix='')
+        users = set()
+        for row in expired:
+            name, user = characters.get(row.character_id, ('Unknown', None))
+            paginator.add_line("{}'s {} ran out".format(name, row.name))
+            if user not in (None, m.dmkey):
+                users.add('<@{}>'.format(user))
+        content = ' '.join(sorted(users)) or None
+        for page in paginator.pages:
+            try:
+                await channel.send(content=content, embed=discord.Embed(description=page))
+            except discord.HTTPException:
+                logger.exception('Could not announce timers in channel %s', channel_id)
+            content = None
+
+
+async def run(bot, Session):
+    '''
+    Advances the wheel every second and stops the timers that ran out
+    '''
+    await bot.wait_until_ready()
+    try:
+        load(Session, bot)
+    except Exception:
+        logger.exception('Could not load running timers')
+    while True:
+        await asyncio.sleep(max(wheel.tick + 1 - time.time(), 0))
+        due = []
+        now = int(time.time())
+        while wheel.tick < now:
+            due.extend(wheel.advance())
+        if not due:
+            continue
+        try:
+            with closing(Session()) as session:
+                rows = expire(session, due)
+                if rows:
+                    await announce(bot, session, rows)
+        except Exception:
+            logger.exception('Could not stop timers that ran out')
+            for timer_id in due:
+                wheel.schedule(timer_id, wheel.tick + retry_delay)
+
+
+@changes.subscribe
+def apply(committed):
+    if session_factory is None:
+        return
+    # restored servers come back with new timer ids
+    restored = [
+        change.key for change in committed
+        if change.table == m.ServerArchive.__tablename__ and change.new is None
+    ]
+    if restored:
+        with closing(session_factory()) as session:
+            for server in restored:
+                schedule_visible(client, running(session, server))
@@ -3,7 +3,9 @@ from discord.ext import commands
 from sqlalchemy.exc import IntegrityError
 
 from . import util
+from . import repository
 from .util import m
+from .initiative import remove_combatant
 
 
 class CharacterCategory (util.Cog):
@@ -24,8 +26,7 @@ class CharacterCategory (util.Cog):
         '''
         name = util.strip_quotes(name)
 
-        character = ctx.session.query(m.Character)\
-            .filter_by(name=name, server=str(ctx.guild.id)).one_or_none()
+        character = repository.get_named_character(ctx.session, name, ctx.guild.id)
 
         if character is None:
             character = m.Character(name=name, server=str(ctx.guild.id))
@@ -48,13 +49,11 @@ class CharacterCategory (util.Cog):
         '''
         name = util.strip_quotes(name)
 
-        character = ctx.session.query(m.Character)\
-            .filter_by(name=name, server=str(ctx.guild.id)).one_or_none()
+        character = repository.get_named_character(ctx.session, name, ctx.guild.id)
 
         if character is not None:
             if character.user is None:
-                user = ctx.session.query(m.Character)\
-                    .filter_by(user=str(ctx.author.id), server=str(ctx.guild.id)).one_or_none()
+                user = repository.get_character(ctx.session, ctx.author.id, ctx.guild.id)
                 if user is not None:
                     user.user = None
                     ctx.session.commit()
@@ -89,8 +88,7 @@ class CharacterCategory (util.Cog):
         '''
         Removes a character association
         '''
-        character = ctx.session.query(m.Character)\
-            .filter_by(user=str(ctx.author.id), server=str(ctx.guild.id)).one_or_none()
+        character = repository.get_character(ctx.session, ctx.author.id, ctx.guild.id)
         if character is not None:
             character.user = None
             ctx.session.commit()
@@ -100,6 +98,7 @@ class CharacterCategory (util.Cog):
             raise util.NoCharacterError
 
     @commands.command(ignore_extra=False)
+    @util.read_only
     async def whois(self, ctx, user: discord.Member):
         '''
         Retrieves character information for a user
@@ -111,6 +110,7 @@ class CharacterCategory (util.Cog):
         await util.send_embed(ctx, author=user, description='{} is {}'.format(user.mention, str(character)))
 
     @commands.command(ignore_extra=False)
+    @util.read_only
     async def whoami(self, ctx):
         '''
         Retrieves character information for yourself
@@ -139,14 +139,13 @@ class CharacterCategory (util.Cog):
             raise Exception('There is already a character with that name')
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def list(self, ctx):
         '''
         Lists all of the characters for this server
         Does not list DM characters
         '''
-        characters = ctx.session.query(m.Character)\
-            .filter(~m.Character.dm_character)\
-            .filter_by(server=str(ctx.guild.id)).all()
+        characters = repository.list_characters(ctx.session, ctx.guild.id)
         pages = commands.Paginator(prefix='', suffix='')
         pages.add_line('All characters:')
         for character in characters:
@@ -197,8 +196,7 @@ class CharacterCategory (util.Cog):
         '''
         if rest not in ['short', 'long']:
             raise commands.BadArgument('Bad argument: rest')
-        characters = ctx.session.query(m.Character)\
-            .filter_by(server=str(ctx.guild.id)).all()
+        characters = repository.list_characters(ctx.session, ctx.guild.id, players_only=False)
 
         for character in characters:
             self.recover_resources(ctx, character, rest)
@@ -216,8 +214,7 @@ class CharacterCategory (util.Cog):
         Parameters:
         [character] the name of the character to remove user from
         '''
-        character = ctx.session.query(m.Character)\
-            .filter_by(name=character, server=str(ctx.guild.id)).one_or_none()
+        character = repository.get_named_character(ctx.session, character, ctx.guild.id)
         if character is None:
             raise Exception('Could not find character with that name')
         if character.user is not None:
@@ -246,12 +243,17 @@ class CharacterCategory (util.Cog):
         [confirmation] enter `100%` to confirm that you want to delete the character permanently
         '''
         if confirmation == '100%':
-            character = ctx.session.query(m.Character)\
-                .filter_by(name=name, server=str(ctx.guild.id)).one_or_none()
+            character = repository.get_named_character(ctx.session, name, ctx.guild.id)
             if character is not None:
                 for attribute in character.attributes:
                     for item in getattr(character, attribute):
                         ctx.session.delete(item)
+                for combatant in ctx.session.query(m.Combatant).filter_by(character_id=character.id):
+                    remove_combatant(ctx.session, combatant.encounter, combatant)
+                ctx.session.query(m.RollRecord)\
+                    .filter_by(character_id=character.id).delete(synchronize_session=False)
+                ctx.session.query(m.RollStats)\
+                    .filter_by(character_id=character.id).delete(synchronize_session=False)
                 ctx.session.commit()
                 ctx.session.delete(character)
                 ctx.session.commit()
@@ -0,0 +1,305 @@
+import io
+import os
+import gc
+import sys
+import copy
+import pstats
+import cProfile
+import logging
+import datetime
+import tracemalloc
+from collections import Counter
+
+from discord.ext import commands
+from sqlalchemy.orm import Session
+
+from . import util
+from . import repository
+from .util import m
+from .. import metrics, dispatch, history, stats, archive, rng, clock
+
+logger = logging.getLogger(__name__)
+
+# the number of packages and allocation sites listed, three times as many functions are listed in profiles
+top_count = 10
+
+# the snapshot the next memory report is compared to
+snapshot = None
+
+# where profiles of the next uses of a command are written
+profile_directory = 'profiles'
+
+# the number of uses left to profile by qualified command name
+profiling = {}
+
+# only one profiler can run at a time, this is it
+active = None
+
+
+def module_files():
+    '''
+    Gets the module name of each loaded source file
+    '''
+    return {
+        getattr(module, '__file__', None): name
+        for name, module in list(sys.modules.items())
+    }
+
+
+def size(value, signed=True):
+    '''
+    Formats a number of bytes
+    [signed] whether to show the sign of positive numbers, for changes
+    '''
+    sign = '-' if value < 0 else '+' if signed else ''
+    value = abs(value)
+    for unit in ['B', 'KiB', 'MiB']:
+        if value < 1024:
+            return '{}{:.0f} {}'.format(sign, value, unit)
+        value /= 1024
+    return '{}{:.1f} GiB'.format(sign, value)
+
+
+def allocations(old, new):
+    '''
+    Lists the change in memory use between two snapshots, by package and by line
+    '''
+    # leave out the memory used by tracemalloc itself
+    ignored = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ]
+    old = old.filter_traces(ignored)
+    new = new.filter_traces(ignored)
+    files = module_files()
+
+    packages = Counter()
+    for stat in new.compare_to(old, 'filename'):
+        name = files.get(stat.traceback[0].filename, 'other')
+        packages[name.split('.')[0]] += stat.size_diff
+
+    lines = ['**Change by package**']
+    for package, change in sorted(packages.items(), key=lambda item: -abs(item[1]))[:top_count]:
+        lines.append('`{}`: {}'.format(package, size(change)))
+
+    lines.append('**Change by line**')
+    for stat in new.compare_to(old, 'lineno')[:top_count]:
+        frame = stat.traceback[0]
+        lines.append('`{}:{}`: {} in {:+} blocks'.format(
+            files.get(frame.filename, frame.filename), frame.lineno, size(stat.size_diff), stat.count_diff))
+    return lines
+
+
+def live_objects():
+    '''
+    Counts the ORM objects in memory by class, and the sessions and the objects in their identity maps
+    '''
+    objects = Counter()
+    sessions = 0
+    identities = 0
+    for obj in gc.get_objects():
+        if isinstance(obj, m.Base):
+            objects[type(obj).__name__] += 1
+        elif isinstance(obj, Session):
+            sessions += 1
+            identities += len(obj.identity_map)
+    return objects, sessions, identities
+
+
+def cache_sizes(bot):
+    '''
+    Gets the number of entries in each cache the bot keeps
+    '''
+    for name, hits, misses, entries in metrics.caches():
+        yield name, entries
+    yield 'baked_queries', len(repository.bakery.cache)
+    yield 'deletable_messages', len(util.deletable)
+    yield 'prefixes', len(dispatch.prefixes)
+    yield 'archived_servers', len(archive.archived)
+    yield 'random_buffers', sum(len(buffer) for source in rng.sources.values() for buffer in source.buffers.values())
+    yield 'unwritten_rolls', len(history.log)
+    yield 'unwritten_stats', len(stats.tally)
+    yield 'clock_timers', len(clock.wheel)
+    yield 'discord_guilds', len(bot.guilds)
+    yield 'discord_users', len(bot.users)
+    yield 'discord_messages', len(getattr(bot, 'cached_messages', ()))
+
+
+def command_started(ctx):
+    '''
+    Starts profiling a command if its next uses are being profiled
+    '''
+    global active
+    if active is not None or ctx.command is None or not profiling.get(ctx.command.qualified_name):
+        return
+    active = ctx.profiler = cProfile.Profile()
+    ctx.profiler.enable()
+
+
+def command_finished(ctx):
+    '''
+    Writes the profile of a command started by command_started
+    '''
+    global active
+    profiler = getattr(ctx, 'profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    active = None
+    name = ctx.command.qualified_name
+    profiling[name] -= 1
+    if not profiling[name]:
+        del profiling[name]
+    os.makedirs(profile_directory, exist_ok=True)
+    path = os.path.join(profile_directory, '{}-{:%Y%m%d-%H%M%S}-{}.pstats'.format(
+        name.replace(' ', '_'), datetime.datetime.utcnow(), ctx.message.id))
+    profiler.dump_stats(path)
+    logger.info('Wrote profile of %s to %s', name, path)
+
+
+def is_debug(command):
+    return command is not None and command.root_parent is not None and command.root_parent.name == 'debug'
+
+
+class DebugCategory (util.Cog):
+    @commands.group('debug', hidden=True, invoke_without_command=True)
+    @commands.is_owner()
+    async def group(self, ctx):
+        '''
+        Commands for finding problems with the running bot
+        Can only be used by the owner of the bot
+        '''
+        raise util.invalid_subcommand(ctx)
+
+    @group.command(ignore_extra=False)
+    @commands.is_owner()
+    async def memory(self, ctx, action: str = 'report', frames: int = 1):
+        '''
+        Shows where the bot's memory goes
+        Can only be used by the owner of the bot
+
+        Parameters:
+        [action] (optional) one of report|start|stop
+            report: lists the sizes of the caches and the ORM objects in memory
+                while tracing, also the memory allocated since the last report by package and by line
+            start: starts tracing memory allocations, this slows the bot down
+            stop: stops tracing
+        [frames] (optional) the number of stack frames kept for each allocation when starting
+        '''
+        global snapshot
+        if action == 'start':
+            if frames < 1:
+                raise commands.BadArgument('Bad argument: frames')
+            tracemalloc.start(frames)
+            snapshot = tracemalloc.take_snapshot()
+            await util.send_embed(ctx, author=False, description='Tracing memory allocations')
+            return
+        elif action == 'stop':
+            tracemalloc.stop()
+            snapshot = None
+            await util.send_embed(ctx, author=False, description='Stopped tracing memory allocations')
+            return
+        elif action != 'report':
+            raise commands.BadArgument('Bad argument: action')
+
+        paginator = commands.Paginator(prefix='', suffix='')
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            paginator.add_line('**Traced memory**: {} (peak {})'.format(size(current, False), size(peak, False)))
+            new = tracemalloc.take_snapshot()
+            if snapshot is not None:
+                for line in allocations(snapshot, new):
+                    paginator.add_line(line)
+            snapshot = new
+        else:
+            paginator.add_line('Use `{}debug memory start` to trace allocations'.format(ctx.prefix))
+
+        paginator.add_line('**Caches**')
+        for name, entries in cache_sizes(ctx.bot):
+            paginator.add_line('`{}`: {}'.format(name, entries))
+
+        objects, sessions, identities = live_objects()
+        paginator.add_line('**ORM objects**: {} in the identity maps of {} sessions'.format(identities, sessions))
+        for name, count in objects.most_common():
+            paginator.add_line('`{}`: {}'.format(name, count))
+
+        await util.send_pages(ctx, paginator)
+
+    @group.group('profile', invoke_without_command=True)
+    @commands.is_owner()
+    async def profile(self, ctx, *, command: str):
+        '''
+        Runs a command under the profiler and lists the functions it spent the most time in
+        The command runs as if you had sent it, with the normal checks and database setup
+        Time the event loop spent on other messages while the command waited is included
+        Can only be used by the owner of the bot
+
+        Parameters:
+        [command*] the command to run, without the prefix
+        '''
+        global active
+        if active is not None:
+            raise Exception('Another command is being profiled')
+
+        message = copy.copy(ctx.message)
+        message.content = ctx.prefix + util.strip_quotes(command)
+        profiled = await ctx.bot.get_context(message)
+        if not profiled.valid:
+            raise commands.CommandNotFound('Command "{}" is not found'.format(command.split()[0]))
+        if is_debug(profiled.command):
+            raise Exception('Debug commands cannot be profiled')
+
+        active = profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await ctx.bot.invoke(profiled)
+        finally:
+            profiler.disable()
+            active = None
+
+        text = io.StringIO()
+        stats = pstats.Stats(profiler, stream=text)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(top_count * 3)
+        paginator = commands.Paginator()
+        paginator.add_line('{} calls in {:.3f} seconds'.format(stats.total_calls, stats.total_tt))
+        # skip pstats' own summary lines, down to the table
+        lines = text.getvalue().splitlines()
+        start = next((i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')), 0)
+        for line in lines[start:]:
+            if line.strip():
+                paginator.add_line(line[:1900])
+        await util.send_pages(ctx, paginator)
+
+    @profile.command('next', ignore_extra=False)
+    @commands.is_owner()
+    async def profile_next(self, ctx, count: int, *, command: str):
+        '''
+        Profiles the next uses of a command by anyone
+        Each profile is written to a .pstats file in the profiles directory of the bot
+        Can only be used by the owner of the bot
+
+        Parameters:
+        [count] the number of uses to profile, 0 to stop profiling the command
+        [command*] the name of the command, such as `roll` or `initiative next`
+        '''
+        if count < 0:
+            raise commands.BadArgument('Bad argument: count')
+        found = ctx.bot.get_command(util.strip_quotes(command))
+        if found is None:
+            raise commands.CommandNotFound('Command "{}" is not found'.format(command))
+        if is_debug(found):
+            raise Exception('Debug commands cannot be profiled')
+
+        name = found.qualified_name
+        if count:
+            profiling[name] = count
+            message = 'Profiling the next {} uses of `{}` into `{}`'.format(
+                count, name, os.path.abspath(profile_directory))
+        else:
+            profiling.pop(name, None)
+            message = 'Stopped profiling `{}`'.format(name)
+        await util.send_embed(ctx, author=False, description=message)
+
+
+def setup(bot):
+    bot.add_cog(DebugCategory(bot))
@@ -50,10 +50,7 @@ class InformationCategory (util.Cog):
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        info = ctx.session.query(m.Information)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if info is None:
-            raise util.ItemNotFoundError(name)
+        info = util.get_attribute(ctx.session, m.Information, character, name)
 
         try:
             info.name = new_name
@@ -77,10 +74,7 @@ class InformationCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        info = ctx.session.query(m.Information)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if info is None:
-            raise util.ItemNotFoundError(name)
+        info = util.get_attribute(ctx.session, m.Information, character, name)
 
         info.description = description
         ctx.session.commit()
@@ -99,6 +93,7 @@ class InformationCategory (util.Cog):
         await ctx.invoke(self.description, name, description='')
 
     @group.command()
+    @util.read_only
     async def check(self, ctx, *, name: str):
         '''
         Shows the information block
@@ -109,16 +104,14 @@ class InformationCategory (util.Cog):
         name = util.strip_quotes(name)
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
-        info = ctx.session.query(m.Information)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if info is None:
-            raise util.ItemNotFoundError(name)
+        info = util.get_attribute(ctx.session, m.Information, character, name)
         text = '**{}**'.format(str(info))
         if info.description:
             text += '\n' + info.description
         await util.send_embed(ctx, description=text)
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def list(self, ctx):
         '''
         Lists character's information
@@ -126,6 +119,19 @@ class InformationCategory (util.Cog):
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
         await util.inspector(ctx, character, 'information', desc=True)
 
+    @group.command(ignore_extra=False)
+    @util.read_only
+    async def search(self, ctx, query: str, page: int = 1):
+        '''
+        Searches the names and descriptions of a character's information blocks
+        Best matches are listed first
+
+        Parameters:
+        [query] the words to search for
+        [page] (optional) the page of results to show
+        '''
+        await util.searcher(ctx, m.Information, query, page)
+
     @group.command(aliases=['delete'])
     async def remove(self, ctx, *, name: str):
         '''
@@ -139,16 +145,12 @@ class InformationCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        info = ctx.session.query(m.Information)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if info is None:
-            raise util.ItemNotFoundError(name)
-
-        ctx.session.delete(info)
+        info = util.delete_attribute(ctx.session, m.Information, character, name)
         ctx.session.commit()
         await util.send_embed(ctx, description='{} removed'.format(str(info)))
 
     @group.command()
+    @util.read_only
     async def inspect(self, ctx, *, name: str):
         '''
         Lists the information for a specified character
@@ -0,0 +1,276 @@
+from discord.ext import commands
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import selectinload
+import equations
+
+from . import util
+from .util import m
+from .rolls import do_roll, send_roll
+from .. import changes
+
+
+def get_encounter(ctx):
+    '''
+    Gets the encounter for the channel of a command
+    '''
+    encounter = ctx.session.query(m.Encounter)\
+        .filter_by(channel=str(ctx.channel.id)).one_or_none()
+    if encounter is None:
+        raise Exception('There is no encounter in this channel')
+    return encounter
+
+
+def initiative_expression(character):
+    '''
+    Gets the expression to roll initiative for a character
+    Uses the character's saved `initiative` roll if it has one
+    '''
+    if any(roll.name == 'initiative' for roll in character.rolls):
+        return 'initiative'
+    return '1d20'
+
+
+def set_combatant(session, encounter, name, initiative, character=None):
+    '''
+    Adds a combatant to an encounter or updates its initiative
+    '''
+    combatant = session.query(m.Combatant)\
+        .filter_by(encounter_id=encounter.id, name=name).one_or_none()
+    if combatant is None:
+        combatant = m.Combatant(encounter_id=encounter.id, name=name)
+        session.add(combatant)
+    combatant.character_id = character.id if character else None
+    combatant.initiative = initiative
+    return combatant
+
+
+def turn_order(session, encounter):
+    '''
+    Query for the combatants of an encounter in the order they act
+    '''
+    return session.query(m.Combatant)\
+        .filter_by(encounter_id=encounter.id)\
+        .order_by(m.Combatant.initiative.desc(), m.Combatant.id)
+
+
+def after(session, encounter, combatant):
+    '''
+    Gets the combatant that acts after another, None at the end of the order
+    '''
+    return turn_order(session, encounter).filter(or_(
+        m.Combatant.initiative < combatant.initiative,
+        and_(m.Combatant.initiative == combatant.initiative, m.Combatant.id > combatant.id))).first()
+
+
+def remove_combatant(session, encounter, combatant):
+    '''
+    Deletes a combatant, passing the turn on if it was theirs
+    '''
+    if encounter.turn == combatant.id:
+        # the turn passes to the next combatant, or the top of the order
+        successor = after(session, encounter, combatant) or turn_order(session, encounter)\
+            .filter(m.Combatant.id != combatant.id).first()
+        encounter.turn = successor.id if successor else None
+    session.delete(combatant)
+
+
+class InitiativeCategory (util.Cog):
+    @commands.group('initiative', aliases=['init'], invoke_without_command=True)
+    async def group(self, ctx):
+        '''
+        Tracks the turn order of encounters
+
+        Each channel can have one encounter running at a time
+        Combatants act from highest to lowest initiative, ties go to whoever joined first
+        '''
+        raise util.invalid_subcommand(ctx)
+
+    @group.command(ignore_extra=False)
+    @commands.has_permissions(administrator=True)
+    async def start(self, ctx):
+        '''
+        Starts an encounter in this channel
+        Can only be done by an administrator
+        '''
+        encounter = ctx.session.query(m.Encounter)\
+            .filter_by(channel=str(ctx.channel.id)).one_or_none()
+        if encounter is not None:
+            raise Exception('There is already an encounter in this channel')
+
+        ctx.session.add(m.Encounter(server=str(ctx.guild.id), channel=str(ctx.channel.id)))
+        ctx.session.commit()
+        await util.send_embed(ctx, author=False, description='Roll for initiative!')
+
+    @group.command()
+    async def join(self, ctx, *, expression: str = None):
+        '''
+        Rolls initiative for your character and adds it to the encounter
+        Rolling again replaces the previous initiative
+
+        Parameters:
+        [expression*] (optional) the dice expression to roll
+            defaults to the character's `initiative` roll, or 1d20 if it has none
+        '''
+        encounter = get_encounter(ctx)
+        character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
+        if expression:
+            expression = util.strip_quotes(expression)
+        else:
+            expression = initiative_expression(character)
+
+        output = []
+        detail = []
+        initiative = int(await do_roll(expression, ctx.session, character, output=output, detail=detail))
+        set_combatant(ctx.session, encounter, character.name, initiative, character)
+        ctx.session.commit()
+        await send_roll(ctx, output, detail)
+
+    @group.command()
+    @commands.has_permissions(administrator=True)
+    async def add(self, ctx, name: str, *, expression: str):
+        '''
+        Adds a combatant without a character, such as a monster
+        Can only be done by an administrator
+
+        Parameters:
+        [name] the name of the combatant
+        [expression*] the initiative or a dice expression to roll for it
+        '''
+        expression = util.strip_quotes(expression)
+        encounter = get_encounter(ctx)
+
+        output = []
+        detail = []
+        initiative = int(await do_roll(expression, ctx.session, output=output, server=ctx.guild.id, detail=detail))
+        set_combatant(ctx.session, encounter, name, initiative)
+        ctx.session.commit()
+        output[-1] = detail[-1] = '{} rolled {}'.format(name, initiative)
+        await send_roll(ctx, output, detail, author=False)
+
+    @group.command(ignore_extra=False)
+    @commands.has_permissions(administrator=True)
+    async def rollall(self, ctx):
+        '''
+        Rolls initiative for every character on the server and adds them to the encounter
+        Uses each character's `initiative` roll, or 1d20 if it has none
+        Characters whose initiative cannot be rolled are listed and left out
+        Can only be done by an administrator
+        '''
+        encounter = get_encounter(ctx)
+        characters = ctx.session.query(m.Character)\
+            .options(selectinload(m.Character.rolls), selectinload(m.Character.variables))\
+            .filter(~m.Character.dm_character)\
+            .filter_by(server=str(ctx.guild.id)).all()
+
+        failures = []
+        for character in characters:
+            expression = initiative_expression(character)
+            try:
+                initiative = int(await do_roll(expression, ctx.session, character, output=[]))
+            except equations.EquationError:
+                failures.append('{}: could not roll `{}`'.format(str(character), expression))
+                continue
+            set_combatant(ctx.session, encounter, character.name, initiative, character)
+        ctx.session.commit()
+
+        await ctx.invoke(self.list)
+        if failures:
+            await util.send_embed(ctx, author=False, description='\n'.join(failures))
+
+    @group.command(aliases=['endturn'], ignore_extra=False)
+    async def next(self, ctx):
+        '''
+        Ends the current turn and moves to the next combatant
+        Running timers of the combatant whose turn ended change by their deltas
+        '''
+        encounter = get_encounter(ctx)
+        current = ctx.session.query(m.Combatant).get(encounter.turn) if encounter.turn is not None else None
+
+        lines = []
+        combatant = None
+        if current is not None:
+            if current.character_id is not None:
+                ticked = ctx.session.query(m.Timer)\
+                    .filter(m.Timer.character_id == current.character_id, m.Timer.value.isnot(None),
+                            m.Timer.expires.is_(None))\
+                    .update({m.Timer.value: m.Timer.value + m.Timer.delta}, synchronize_session=False)
+                if ticked:
+                    changes.record(ctx.session, m.Timer.__tablename__, current.character_id)
+                    lines.append("{}'s timers ticked".format(current.name))
+            lines.append("{}'s turn is over".format(current.name))
+            combatant = after(ctx.session, encounter, current)
+
+        if combatant is None:
+            # wrap around to the top of the order
+            combatant = turn_order(ctx.session, encounter).first()
+            if combatant is None:
+                raise Exception('There are no combatants in this encounter')
+            if current is not None:
+                encounter.round += 1
+
+        encounter.turn = combatant.id
+        ctx.session.commit()
+
+        player = ''
+        if combatant.character is not None and combatant.character.user not in (None, m.dmkey):
+            player = ' <@{}>'.format(combatant.character.user)
+        lines.append("Round {}: it is {}'s turn{}".format(encounter.round, combatant.name, player))
+        await util.send_embed(ctx, author=False, description='\n'.join(lines))
+
+    @group.command(ignore_extra=False)
+    @util.read_only
+    async def list(self, ctx):
+        '''
+        Shows the initiative order of the encounter
+        '''
+        encounter = get_encounter(ctx)
+
+        paginator = commands.Paginator(prefix='', suffix='')
+        paginator.add_line('Initiative order, round {}:'.format(encounter.round))
+        for combatant in encounter.combatants:
+            line = str(combatant)
+            if combatant.id == encounter.turn:
+                line = '**{}** ◀'.format(line)
+            paginator.add_line(line)
+        await util.send_pages(ctx, paginator)
+
+    @group.command(aliases=['delete'])
+    @commands.has_permissions(administrator=True)
+    async def remove(self, ctx, *, name: str):
+        '''
+        Removes a combatant from the encounter
+        Can only be done by an administrator
+
+        Parameters:
+        [name*] the name of the combatant
+        '''
+        name = util.strip_quotes(name)
+        encounter = get_encounter(ctx)
+
+        combatant = ctx.session.query(m.Combatant)\
+            .filter_by(encounter_id=encounter.id, name=name).one_or_none()
+        if combatant is None:
+            raise util.ItemNotFoundError(name)
+
+        remove_combatant(ctx.session, encounter, combatant)
+        ctx.session.commit()
+        await util.send_embed(ctx, author=False, description='{} removed from the encounter'.format(combatant.name))
+
+    @group.command(ignore_extra=False)
+    @commands.has_permissions(administrator=True)
+    async def end(self, ctx):
+        '''
+        Ends the encounter in this channel
+        Can only be done by an administrator
+        '''
+        encounter = get_encounter(ctx)
+
+        ctx.session.query(m.Combatant)\
+            .filter_by(encounter_id=encounter.id).delete(synchronize_session=False)
+        ctx.session.delete(encounter)
+        ctx.session.commit()
+        await util.send_embed(ctx, author=False, description='The encounter is over')
+
+
+def setup(bot):
+    bot.add_cog(InitiativeCategory(bot))
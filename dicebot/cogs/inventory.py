@@ -53,10 +53,7 @@ class InventoryCategory (util.Cog):
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        item = ctx.session.query(m.Item)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if item is None:
-            raise util.ItemNotFoundError(name)
+        item = util.get_attribute(ctx.session, m.Item, character, name)
 
         try:
             item.name = new_name
@@ -80,10 +77,7 @@ class InventoryCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        item = ctx.session.query(m.Item)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if item is None:
-            raise util.ItemNotFoundError(name)
+        item = util.get_attribute(ctx.session, m.Item, character, name)
 
         item.description = description
         ctx.session.commit()
@@ -114,10 +108,7 @@ class InventoryCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        item = ctx.session.query(m.Item)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if item is None:
-            raise util.ItemNotFoundError(name)
+        item = util.get_attribute(ctx.session, m.Item, character, name)
 
         item.number = number
         ctx.session.commit()
@@ -136,14 +127,10 @@ class InventoryCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        item = ctx.session.query(m.Item)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
+        item = util.increment(ctx.session, m.Item, character, name, 'number', number)
         if item is None:
-            raise util.ItemNotFoundError(name)
-
-        item.number += number
-        ctx.session.commit()
-        await util.send_embed(ctx, description='{} now has {}'.format(str(character), str(item)))
+            raise util.not_found(ctx.session, m.Item, character, name)
+        await util.send_embed(ctx, description='{} now has {}: {}'.format(str(character), item.name, item.number))
 
     @group.command('-')
     async def minus(self, ctx, number: int, *, name: str):
@@ -159,6 +146,7 @@ class InventoryCategory (util.Cog):
         await ctx.invoke(self.plus, -number, name=name)
 
     @group.command()
+    @util.read_only
     async def check(self, ctx, *, name: str):
         '''
         Checks the status of an item
@@ -169,16 +157,14 @@ class InventoryCategory (util.Cog):
         name = util.strip_quotes(name)
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
-        item = ctx.session.query(m.Item)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if item is None:
-            raise util.ItemNotFoundError(name)
+        item = util.get_attribute(ctx.session, m.Item, character, name)
         text = '**{}**'.format(str(item))
         if item.description:
             text += '\n' + item.description
         await util.send_embed(ctx, description=text)
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def list(self, ctx):
         '''
         Lists character's inventory
@@ -200,16 +186,12 @@ class InventoryCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        item = ctx.session.query(m.Item)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if item is None:
-            raise util.ItemNotFoundError(name)
-
-        ctx.session.delete(item)
+        item = util.delete_attribute(ctx.session, m.Item, character, name)
         ctx.session.commit()
         await util.send_embed(ctx, description='{} removed'.format(str(item)))
 
     @group.command()
+    @util.read_only
     async def inspect(self, ctx, *, name: str):
         '''
         Lists the inventory for a specified character
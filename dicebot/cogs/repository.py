@@ -0,0 +1,139 @@
+'''
+Shared queries for the lookups that almost every command makes
+
+The queries are baked, SQLAlchemy builds and compiles each one the first time it is used
+and later calls only bind new parameters
+Run this module to compare them with building the same queries on every call
+'''
+
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+
+from .. import model as m
+
+bakery = baked.bakery()
+
+player_character = bakery(lambda session: session.query(m.Character))
+player_character += lambda q: q.filter(~m.Character.dm_character)
+player_character += lambda q: q.filter(
+    m.Character.user == bindparam('user'),
+    m.Character.server == bindparam('server'))
+
+named_character = bakery(lambda session: session.query(m.Character))
+named_character += lambda q: q.filter(
+    m.Character.name == bindparam('name'),
+    m.Character.server == bindparam('server'))
+
+server_characters = bakery(lambda session: session.query(m.Character))
+server_characters += lambda q: q.filter(m.Character.server == bindparam('server'))
+
+
+def get_character(session, user, server):
+    '''
+    Gets the character of a user, None if they don't have one
+    '''
+    return player_character(session).params(user=str(user), server=str(server)).one_or_none()
+
+
+def get_named_character(session, name, server, players_only=False):
+    '''
+    Gets a character by name, None if there is no such character
+    [players_only] whether to ignore DM characters
+    '''
+    query = named_character
+    if players_only:
+        query = query.with_criteria(lambda q: q.filter(~m.Character.dm_character))
+    return query(session).params(name=name, server=str(server)).one_or_none()
+
+
+def list_characters(session, server, players_only=True):
+    '''
+    Lists the characters on a server
+    [players_only] whether to leave out DM characters
+    '''
+    query = server_characters
+    if players_only:
+        query = query.with_criteria(lambda q: q.filter(~m.Character.dm_character))
+    return query(session).params(server=str(server)).all()
+
+
+def get_attribute(session, type, character_id, name):
+    '''
+    Gets a character attribute by name, None if there is no such attribute
+    '''
+    query = bakery(lambda session: session.query(type), type)
+    query += lambda q: q.filter(type.character_id == bindparam('character_id'), type.name == bindparam('name'))
+    return query(session).params(character_id=character_id, name=name).one_or_none()
+
+
+def list_attributes(session, type, character_id, **filters):
+    '''
+    Lists one kind of attribute of a character in order of name
+    [filters] columns that have to equal the given values
+    '''
+    query = bakery(lambda session: session.query(type), type)
+    query += lambda q: q.filter(type.character_id == bindparam('character_id'))
+    for column in sorted(filters):
+        # the column is part of the cache key, and bound as a default as the step runs later
+        query.add_criteria(lambda q, column=column: q.filter(getattr(type, column) == bindparam(column)), column)
+    query += lambda q: q.order_by(type.name)
+    return query(session).params(character_id=character_id, **filters).all()
+
+
+def delete_attribute(session, type, character_id, name):
+    '''
+    Deletes a character attribute by name, the deletion is written when the session is flushed
+    Returns the deleted attribute, None if there is no such attribute
+    '''
+    item = get_attribute(session, type, character_id, name)
+    if item is not None:
+        session.delete(item)
+    return item
+
+
+if __name__ == '__main__':
+    import timeit
+    from contextlib import closing
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    engine = create_engine('sqlite://')
+    m.Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+
+    with closing(Session()) as session:
+        for i in range(50):
+            character = m.Character(name='character {}'.format(i), server='1', user=str(i))
+            session.add(character)
+            for j in range(20):
+                session.add(m.Variable(character=character, name='variable {}'.format(j), value=j))
+        session.commit()
+
+        def plain_character():
+            session.query(m.Character)\
+                .filter(~m.Character.dm_character)\
+                .filter_by(user='25', server='1').one_or_none()
+
+        def plain_attribute():
+            session.query(m.Variable)\
+                .filter_by(character_id=25, name='variable 10').one_or_none()
+
+        def plain_list():
+            session.query(m.Variable)\
+                .filter_by(character_id=25, value=10)\
+                .order_by(m.Variable.name).all()
+
+        benchmarks = [
+            ('get character', plain_character, lambda: get_character(session, 25, 1)),
+            ('get attribute', plain_attribute, lambda: get_attribute(session, m.Variable, 25, 'variable 10')),
+            ('list attributes', plain_list, lambda: list_attributes(session, m.Variable, 25, value=10)),
+        ]
+        number = 2000
+        print('{:<16} {:>10} {:>10} {:>8}'.format('query', 'plain us', 'baked us', 'saved'))
+        for name, plain, cached in benchmarks:
+            cached()
+            plain_time = min(timeit.repeat(plain, number=number, repeat=3)) / number * 1e6
+            baked_time = min(timeit.repeat(cached, number=number, repeat=3)) / number * 1e6
+            print('{:<16} {:>10.1f} {:>10.1f} {:>7.0%}'.format(
+                name, plain_time, baked_time, 1 - baked_time / plain_time))
@@ -1,6 +1,7 @@
 from discord.ext import commands
 
 from . import util
+from . import repository
 from .util import m
 from .rolls import do_roll
 
@@ -58,16 +59,17 @@ class ResourceCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        resource = ctx.session.query(m.Resource)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if resource is None:
-            raise util.ItemNotFoundError(name)
+        await self.change(ctx, character, name, number)
 
-        prev = resource.current
-        resource.current = resource.current + number
-        ctx.session.commit()
+    async def change(self, ctx, character, name, number):
+        '''
+        Adds to the remaining uses of a resource and reports the change
+        '''
+        resource = util.increment(ctx.session, m.Resource, character, name, 'current', number)
+        if resource is None:
+            raise util.not_found(ctx.session, m.Resource, character, name)
         description = "{0}'s {1} went from {2}/{4} to {3}/{4}".format(
-            str(character), resource.name, prev, resource.current, resource.max)
+            str(character), resource.name, resource.current - number, resource.current, resource.max)
         await util.send_embed(ctx, description=description)
 
     @group.command('-')
@@ -95,20 +97,13 @@ class ResourceCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        resource = ctx.session.query(m.Resource)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
+        resource = util.increment(ctx.session, m.Resource, character, name, 'current', -1, m.Resource.current >= 1)
         if resource is None:
-            raise util.ItemNotFoundError(name)
-
-        if resource.current >= 1:
-            prev = resource.current
-            resource.current = resource.current - 1
-            ctx.session.commit()
-            description = "{0}'s {1} went from {2}/{4} to {3}/{4}".format(
-                str(character), resource.name, prev, resource.current, resource.max)
-        else:
+            resource = util.get_attribute(ctx.session, m.Resource, character, name)
             raise Exception("{} has no {} to use".format(str(character), resource.name))
 
+        description = "{0}'s {1} went from {2}/{4} to {3}/{4}".format(
+            str(character), resource.name, resource.current + 1, resource.current, resource.max)
         await util.send_embed(ctx, description=description)
 
     @group.command(ignore_extra=False)
@@ -122,10 +117,7 @@ class ResourceCategory (util.Cog):
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        resource = ctx.session.query(m.Resource)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if resource is None:
-            raise util.ItemNotFoundError(name)
+        resource = util.get_attribute(ctx.session, m.Resource, character, name)
 
         resource.current = uses
         ctx.session.commit()
@@ -146,10 +138,7 @@ class ResourceCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        resource = ctx.session.query(m.Resource)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if resource is None:
-            raise util.ItemNotFoundError(name)
+        resource = util.get_attribute(ctx.session, m.Resource, character, name)
 
         resource.current = resource.max
         ctx.session.commit()
@@ -181,6 +170,7 @@ class ResourceCategory (util.Cog):
         await ctx.invoke(self.plus, number, name=name)
 
     @group.command()
+    @util.read_only
     async def check(self, ctx, *, name: str):
         '''
         Checks the status of a resource
@@ -191,13 +181,11 @@ class ResourceCategory (util.Cog):
         name = util.strip_quotes(name)
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
-        resource = ctx.session.query(m.Resource)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if resource is None:
-            raise util.ItemNotFoundError(name)
+        resource = util.get_attribute(ctx.session, m.Resource, character, name)
         await util.send_embed(ctx, description=str(resource))
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def list(self, ctx):
         '''
         Lists all of a character's resources
@@ -217,16 +205,12 @@ class ResourceCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        resource = ctx.session.query(m.Resource)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if resource is None:
-            raise util.ItemNotFoundError(name)
-
-        ctx.session.delete(resource)
+        resource = util.delete_attribute(ctx.session, m.Resource, character, name)
         ctx.session.commit()
         await util.send_embed(ctx, description='{} removed'.format(str(resource)))
 
     @group.command()
+    @util.read_only
     async def inspect(self, ctx, *, name: str):
         '''
         Lists the resources for a specified character
@@ -253,22 +237,11 @@ class ResourceCategory (util.Cog):
         '''
         name = util.strip_quotes(name)
 
-        character = ctx.session.query(m.Character)\
-            .filter_by(name=character, server=str(ctx.guild.id)).one_or_none()
+        character = repository.get_named_character(ctx.session, character, ctx.guild.id)
         if character is None:
             raise Exception('Character does not exist')
 
-        resource = ctx.session.query(m.Resource)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if resource is None:
-            raise util.ItemNotFoundError(name)
-
-        prev = resource.current
-        resource.current = resource.current + number
-        ctx.session.commit()
-        description = "{0}'s {1} went from {2}/{4} to {3}/{4}".format(
-            str(character), resource.name, prev, resource.current, resource.max)
-        await util.send_embed(ctx, description=description)
+        await self.change(ctx, character, name, number)
 
 
 def setup(bot):
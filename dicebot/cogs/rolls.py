@@ -1,20 +1,303 @@
 import re
-import random
+import math
+import heapq
 from itertools import chain
+from functools import lru_cache
+from collections import Counter, namedtuple
 
 from discord.ext import commands
-from sqlalchemy import func
+from sqlalchemy.orm import selectinload
 import equations
 
 from . import util
+from . import repository
 from .util import m
+from .. import rng, history, stats
 
+# the most dice a single exploding term can add
+explode_limit = 100
 
-async def do_roll(expression, session, character=None, output=[]):
+# rolls of more dice than this are shown as the number of times each face came up
+summary_dice = 20
+
+# the longest a line of output can be
+line_budget = 200
+
+# the longest the output of a roll can be, lines past this are left out from the middle
+output_budget = 1500
+
+# the full output of each user's last roll that did not fit, shown by `roll detail`
+details = util.LRUCache(64)
+
+
+class Face (namedtuple('Face', ['values', 'dropped'])):
+    '''
+    How one rolled die is displayed
+    [values] every value the die showed as text, the last one counts, earlier ones were rerolled
+    [dropped] whether the die was dropped by keep or drop
+    '''
+    def __str__(self):
+        last = '~~{}~~'.format(self.values[-1]) if self.dropped else self.values[-1]
+        return ' '.join(['~~{}~~'.format(value) for value in self.values[:-1]] + [last])
+
+
+class Dice (int):
+    '''
+    The total of a roll of dice
+    Keeps the individual faces so the keep, drop, reroll and explode operators can change the roll
+    [faces] the faces that count towards the total
+    [sides] the number of sides of the dice
+    [label] the notation of the roll so far, i.e. 4d6kh3
+    [shown] the Face of every die rolled, including dropped dice
+    [index] the position in shown of each face that counts
+    [line] the index of the output line describing the roll, None for silent rolls
+    '''
+    def __new__(cls, faces, sides, label, shown=None, index=None, line=None):
+        self = super().__new__(cls, sum(faces))
+        self.faces = faces
+        self.sides = sides
+        self.label = label
+        self.shown = shown if shown is not None else [Face((str(face),), False) for face in faces]
+        self.index = index if index is not None else list(range(len(faces)))
+        self.line = line
+        return self
+
+    def describe(self, full=False):
+        '''
+        Gets the line of output for the roll
+        Unless full is set, large rolls are summarized by how many times each face came up
+        '''
+        faces = ' + '.join(map(str, self.shown))
+        if not full and (len(self.shown) > summary_dice or len(faces) > line_budget):
+            counts = Counter(self.faces)
+            faces = ', '.join('{}×{}'.format(face, counts[face]) for face in sorted(counts))
+            dropped = len(self.shown) - len(self.faces)
+            if dropped:
+                faces += ', {} dropped'.format(dropped)
+            return truncate('{} (face×count): {}'.format(self.label, faces), line_budget, ' = {}'.format(int(self)))
+        return '{}: {} = {}'.format(self.label, faces, int(self))
+
+    def keep(self, kept, label):
+        '''
+        Gets the roll with only the faces at some positions counting
+        '''
+        shown = list(self.shown)
+        faces = []
+        index = []
+        for i, face in enumerate(self.faces):
+            if i in kept:
+                faces.append(face)
+                index.append(self.index[i])
+            else:
+                shown[self.index[i]] = shown[self.index[i]]._replace(dropped=True)
+        return Dice(faces, self.sides, label, shown, index, self.line)
+
+
+def truncate(text, limit, end=''):
+    '''
+    Shortens text to fit in a number of characters with the end after it
+    '''
+    if len(text) + len(end) > limit:
+        text = text[:max(limit - len(end) - 2, 0)] + ' …'
+    return text + end
+
+
+def shorten(line):
+    '''
+    Shortens a line of output to the line budget, inside the backticks for an expression
+    '''
+    if len(line) > 2 and line.startswith('`') and line.endswith('`'):
+        return '`{}`'.format(truncate(line[1:-1], line_budget - 2))
+    return truncate(line, line_budget)
+
+
+def fit(lines, budget=output_budget):
+    '''
+    Fits the output of a roll in the output budget
+    Long lines are shortened and lines are left out from the middle, the first and last lines are always kept
+    '''
+    lines = [shorten(line) for line in lines]
+    if sum(len(line) + 1 for line in lines) <= budget or len(lines) < 3:
+        return lines
+    first, middle, last = lines[0], lines[1:-1], lines[-1]
+    size = len(first) + len(last) + 100
+    kept = []
+    for line in middle:
+        size += len(line) + 1
+        if size > budget:
+            break
+        kept.append(line)
+    skipped = '… {} more lines, use `roll detail` to see everything'.format(len(middle) - len(kept))
+    return [first] + kept + [skipped, last]
+
+
+def wrap(line, width):
+    '''
+    Splits a line into pieces no wider than width, between dice where possible
+    '''
+    while len(line) > width:
+        cut = line.rfind(' + ', 0, width)
+        if cut <= 0:
+            cut = width
+        yield line[:cut]
+        line = line[cut:]
+    yield line
+
+
+def select(faces, count, highest):
+    '''
+    Gets the positions of the count highest or lowest faces
+    Only the smaller of the kept and dropped sides is put through a heap
+    '''
+    count = min(count, len(faces))
+    positions = range(len(faces))
+    if count * 2 <= len(faces):
+        pick = heapq.nlargest if highest else heapq.nsmallest
+        return set(pick(count, positions, key=faces.__getitem__))
+    else:
+        pick = heapq.nsmallest if highest else heapq.nlargest
+        return set(positions).difference(pick(len(faces) - count, positions, key=faces.__getitem__))
+
+
+@lru_cache(maxsize=256)
+def name_pattern(names):
+    '''
+    Compiles a regex matching any of a tuple of names, longest names first
+    '''
+    return re.compile('|'.join(map(re.escape, sorted(names, key=len, reverse=True))))
+
+
+def solve_constant(expression):
+    '''
+    Works out an expression without dice or variables
+    Returns None if it can't be worked out
+    '''
+    # exponents are left alone so saving a roll can't take arbitrarily long
+    if re.search(r'[a-zA-Z^]|\*\*', expression):
+        return None
+    unary = equations.unary.copy()
+    unary['!'] = lambda a: a // 2 - 5
+    try:
+        value = equations.solve(expression, operations=equations.operations + [{'>': max, '<': min}], unary=unary)
+    except (equations.EquationError, ArithmeticError, TypeError, ValueError):
+        return None
+    if value % 1 == 0:
+        value = int(value)
+    return value
+
+
+def fold(expression):
+    '''
+    Works out the parts of an expression without dice or variables ahead of time
+    The whole expression, or else every parenthesized part that can be worked out, is replaced by its value
+    such as 1d20+(2+3) => 1d20+5, the saved rolls a roll uses are parenthesized when they are expanded
+    '''
+    def group(match):
+        value = solve_constant(match.group(1))
+        if value is None:
+            return match.group(0)
+        # negative values keep their parentheses so they can follow an operator
+        return str(value) if value >= 0 else '({})'.format(value)
+
+    # innermost parentheses first, until nothing changes
+    while True:
+        folded = re.sub(r'\(([^()]*)\)', group, expression)
+        if folded == expression:
+            break
+        expression = folded
+    value = solve_constant(expression)
+    return expression if value is None else str(value)
+
+
+def compile_rolls(expressions, strict=True):
+    '''
+    Expands the saved rolls used by other saved rolls
+    Takes a dict of roll names to expressions and returns a dict of roll names to compiled expressions
+    Raises an exception if rolls use each other in a cycle
+    [strict] whether to raise for cycles, otherwise rolls in or using a cycle are left as written
+    '''
+    if not expressions:
+        return {}
+    pattern = name_pattern(tuple(expressions))
+    uses = {name: set(pattern.findall(expression or '')) for name, expression in expressions.items()}
+
+    # expand each roll after all of the rolls it uses
+    used_by = {name: [] for name in expressions}
+    waiting = {}
+    for name, used in uses.items():
+        waiting[name] = len(used)
+        for other in used:
+            used_by[other].append(name)
+    ready = [name for name, count in waiting.items() if count == 0]
+    compiled = {}
+    while ready:
+        name = ready.pop()
+        expression = pattern.sub(lambda match: '({})'.format(compiled[match.group(0)]), expressions[name] or '')
+        compiled[name] = fold(expression)
+        for other in used_by[name]:
+            waiting[other] -= 1
+            if waiting[other] == 0:
+                ready.append(other)
+
+    if len(compiled) < len(expressions) and not strict:
+        for name, expression in expressions.items():
+            compiled.setdefault(name, expression)
+    elif len(compiled) < len(expressions):
+        # follow uses between the rolls that were never ready until one repeats
+        name = next(name for name in sorted(expressions) if name not in compiled)
+        path = []
+        while name not in path:
+            path.append(name)
+            name = min(other for other in uses[name] if other not in compiled)
+        cycle = path[path.index(name):] + [name]
+        raise Exception('Rolls cannot use themselves: {}'.format(' → '.join(cycle)))
+    return compiled
+
+
+def compile_saved(session):
+    '''
+    Compiles the rolls saved before rolls were compiled and commits
+    Rolls in cycles, which could be saved back then, are stored as written
+    Returns the number of rolls compiled
+    '''
+    uncompiled = session.query(m.Roll.character_id)\
+        .filter(m.Roll.compiled.is_(None)).distinct()
+    rolls = session.query(m.Roll)\
+        .filter(m.Roll.character_id.in_(uncompiled.subquery())).all()
+    characters = {}
+    for roll in rolls:
+        characters.setdefault(roll.character_id, []).append(roll)
+    count = 0
+    for character_rolls in characters.values():
+        count += sum(roll.compiled is None for roll in character_rolls)
+        compiled = compile_rolls({roll.name: roll.expression for roll in character_rolls}, strict=False)
+        update_compiled(character_rolls, compiled)
+    session.commit()
+    return count
+
+
+def update_compiled(rolls, compiled):
+    '''
+    Stores the compiled expressions of a list of rolls
+    '''
+    for roll in rolls:
+        if roll.name in compiled and roll.compiled != compiled[roll.name]:
+            roll.compiled = compiled[roll.name]
+
+
+async def do_roll(expression, session, character=None, output=[], server=None, detail=None, record=True):
     '''
     Does the variable replacement and dice rolling
+    [server] the server rolled on, chooses the random source, defaults to the character's server
+    [detail] (optional) list to fill with the output without large rolls summarized
+    [record] whether to add the character's roll to their history and statistics
     '''
+    if server is None and character is not None:
+        server = character.server
+    source = rng.get(server)
+
     expression = expression.strip()
+    typed = expression
     match = re.match(r'^(.*)\s+((?:dis)?adv|dis|(?:dis)?advantage)$', expression)
     if match:
         expression = match.group(1)
@@ -29,53 +312,51 @@ async def do_roll(expression, session, character=None, output=[]):
 
     original_expression = expression
 
+    # the dice rolled for the character's statistics, as (sides, faces)
+    dice_rolled = []
+
+    # the roll described on each line of output
+    described = {}
+
+    def show(dice):
+        '''
+        Writes the output line of a roll, or replaces it if the roll already has one
+        '''
+        if dice.line is None:
+            dice.line = len(output)
+            output.append(None)
+        output[dice.line] = dice.describe()
+        described[dice.line] = dice
+
     # Set up operations
     def roll_dice(a, b, *, silent=False):
-        rolls = []
-        for _ in range(a):
-            if b > 0:
-                n = random.randint(1, b)
-            elif b < 0:
-                n = random.randint(b, -1)
-            else:
-                n = 0
-            rolls.append(n)
-        value = sum(rolls)
+        if b > 0:
+            rolls = source.randints(a, 1, b)
+            dice_rolled.append((b, rolls))
+        elif b < 0:
+            rolls = source.randints(a, b, -1)
+        else:
+            rolls = [0] * a
+        value = Dice(rolls, b, '{}d{}'.format(a, b))
         if not silent:
-            output.append('{}d{}: {} = {}'.format(a, b, ' + '.join(map(str, rolls)), value))
+            show(value)
         return value
 
     def great_weapon_fighting(a, b, low=2, *, silent=False):
-        rolls = []
-        rerolls = []
-        value = 0
-        for _ in range(a):
-            n = roll_dice(1, b, silent=True)
-            rolls.append(n)
-            if n <= low:
-                n2 = random.randint(1, b)
-                rerolls.append(n2)
-                value += n2
-            else:
-                value += n
+        value = reroll(roll_dice(a, b, silent=True), low)
+        value.label = '{}g{}'.format(a, b)
         if not silent:
-            rolled = ' + '.join(map(str, rolls))
-            if rerolls:
-                rerolled = list(filter(lambda a: a > low, rolls))
-                rerolled.extend(rerolls)
-                rerolled = ' + '.join(map(str, rerolled))
-                output.append('{}g{}: {}, rerolled: {} = {}'.format(a, b, rolled, rerolled, value))
-            else:
-                output.append('{}g{}: {} = {}'.format(a, b, rolled, value))
+            show(value)
         return value
 
     def roll_advantage(a, b, *, silent=False):
         if a == 1 and b == 20:
             first = roll_dice(a, b, silent=True)
             second = roll_dice(a, b, silent=True)
-            out = max(first, second)
+            shown = [Face(('max({}, {})'.format(first, second),), False)]
+            out = Dice([max(first, second)], b, '{}d{}'.format(a, b), shown)
             if not silent:
-                output.append('{}d{}: max({}, {}) = {}'.format(a, b, first, second, out))
+                show(out)
         else:
             out = roll_dice(a, b, silent=silent)
         return out
@@ -84,13 +365,94 @@ async def do_roll(expression, session, character=None, output=[]):
         if a == 1 and b == 20:
             first = roll_dice(a, b, silent=True)
             second = roll_dice(a, b, silent=True)
-            out = min(first, second)
+            shown = [Face(('min({}, {})'.format(first, second),), False)]
+            out = Dice([min(first, second)], b, '{}d{}'.format(a, b), shown)
             if not silent:
-                output.append('{}d{}: min({}, {}) = {}'.format(a, b, first, second, out))
+                show(out)
         else:
             out = roll_dice(a, b, silent=silent)
         return out
 
+    def modifier(operator):
+        '''
+        Makes an operator that changes a roll of dice
+        The operator's function gets the roll and the right operand, and returns the changed roll
+        '''
+        def decorator(function):
+            def operation(dice, n):
+                if not isinstance(dice, Dice):
+                    raise equations.EquationError('`{0}` must follow a roll of dice, i.e. 4d6{0}2'.format(operator))
+                if n < 0 or n % 1 != 0:
+                    raise equations.EquationError('`{}` needs a whole number, not {}'.format(operator, n))
+                label = dice.label + operator + (str(n) if n or operator != '!' else '')
+                out = function(dice, int(n), label)
+                if dice.line is not None:
+                    out.line = dice.line
+                    show(out)
+                return out
+            return operation
+        return decorator
+
+    @modifier('kh')
+    def keep_highest(dice, n, label):
+        return dice.keep(select(dice.faces, n, True), label)
+
+    @modifier('kl')
+    def keep_lowest(dice, n, label):
+        return dice.keep(select(dice.faces, n, False), label)
+
+    @modifier('dh')
+    def drop_highest(dice, n, label):
+        return dice.keep(select(dice.faces, len(dice.faces) - n, False), label)
+
+    @modifier('dl')
+    def drop_lowest(dice, n, label):
+        return dice.keep(select(dice.faces, len(dice.faces) - n, True), label)
+
+    @modifier('r')
+    def reroll(dice, n, label):
+        if dice.sides < 1:
+            raise equations.EquationError('Only dice with sides can be rerolled')
+        low = [i for i, face in enumerate(dice.faces) if face <= n]
+        rerolls = source.randints(len(low), 1, dice.sides)
+        dice_rolled.append((dice.sides, rerolls))
+
+        faces = list(dice.faces)
+        shown = list(dice.shown)
+        for i, face in zip(low, rerolls):
+            faces[i] = face
+            rerolled = shown[dice.index[i]]
+            shown[dice.index[i]] = rerolled._replace(values=rerolled.values + (str(face),))
+        return Dice(faces, dice.sides, label, shown, dice.index)
+
+    @modifier('!')
+    def explode(dice, n, label):
+        threshold = n or dice.sides
+        if threshold < 2 or dice.sides < 2:
+            raise equations.EquationError('Dice can only explode on faces above 1')
+        faces = list(dice.faces)
+        shown = list(dice.shown)
+        index = list(dice.index)
+        pending = [i for i, face in enumerate(faces) if face >= threshold]
+        added = 0
+        while pending and added < explode_limit:
+            pending = pending[:explode_limit - added]
+            for i in pending:
+                exploded = shown[index[i]]
+                shown[index[i]] = exploded._replace(values=exploded.values[:-1] + (exploded.values[-1] + '!',))
+            extra = source.randints(len(pending), 1, dice.sides)
+            dice_rolled.append((dice.sides, extra))
+            added += len(extra)
+
+            pending = []
+            for face in extra:
+                if face >= threshold:
+                    pending.append(len(faces))
+                faces.append(face)
+                index.append(len(shown))
+                shown.append(Face((str(face),), False))
+        return Dice(faces, dice.sides, label, shown, index)
+
     operations = equations.operations.copy()
     operations.append({'>': max, '<': min})
 
@@ -104,6 +466,15 @@ async def do_roll(expression, session, character=None, output=[]):
     dice['D'] = dice['d']
     dice['g'] = great_weapon_fighting
     dice['G'] = dice['g']
+    dice['kh'] = keep_highest
+    dice['k'] = dice['kh']
+    dice['kl'] = keep_lowest
+    dice['dh'] = drop_highest
+    dice['dl'] = drop_lowest
+    dice['r'] = reroll
+    dice['!'] = explode
+    for op in ['kh', 'k', 'kl', 'dh', 'dl', 'r']:
+        dice[op.upper()] = dice[op]
     operations.append(dice)
 
     unary = equations.unary.copy()
@@ -113,29 +484,25 @@ async def do_roll(expression, session, character=None, output=[]):
 
     if character:
         # replace rolls
-        rolls = session.query(m.Roll)\
-            .filter_by(character=character)\
-            .order_by(func.char_length(m.Roll.name).desc())
-        rep = {roll.name: '({})'.format(roll.expression) for roll in rolls}
-        expr = re.compile('|'.join(map(re.escape, sorted(rep.keys(), key=len, reverse=True))))
-        for _ in range(3):
-            expression = expr.sub(lambda m: rep[m.group(0)], expression)
+        rep = {roll.name: roll.compiled for roll in character.rolls}
+        if None in rep.values():
+            # rolls saved by a bot that did not compile rolls yet, startup compiles the rest
+            rep = compile_rolls({roll.name: roll.expression for roll in character.rolls}, strict=False)
+        if rep:
+            expr = name_pattern(tuple(rep))
+            expression = expr.sub(lambda m: '({})'.format(rep[m.group(0)]), expression)
             temp = '`{}`'.format(expression)
             if temp != output[-1]:
                 output.append(temp)
-            else:
-                break
 
         # replace variables
-        variables = session.query(m.Variable)\
-            .filter_by(character=character)\
-            .order_by(func.char_length(m.Variable.name).desc())
-        rep = {var.name: '({})'.format(var.value) for var in variables}
-        expr = re.compile('|'.join(map(re.escape, sorted(rep.keys(), key=len, reverse=True))))
-        expression = expr.sub(lambda m: rep[m.group(0)], expression)
-        temp = '`{}`'.format(expression)
-        if temp != output[-1]:
-            output.append(temp)
+        rep = {var.name: '({})'.format(var.value) for var in character.variables}
+        if rep:
+            expr = name_pattern(tuple(rep))
+            expression = expr.sub(lambda m: rep[m.group(0)], expression)
+            temp = '`{}`'.format(expression)
+            if temp != output[-1]:
+                output.append(temp)
 
     # validate
     for token in re.findall(r'[a-zA-Z]+', expression):
@@ -146,6 +513,9 @@ async def do_roll(expression, session, character=None, output=[]):
                 token = search.group(1)
             raise equations.EquationError('\n{}\nCould not find: `{}`'.format('\n'.join(output), token))
 
+    # a ! with nothing after it explodes on the highest face
+    expression = re.sub(r'(?<=[\d)])(\s*!)(?!\s*[\d(.])', r'\g<1>0', expression)
+
     # do roll
     roll = equations.solve(expression, operations=operations, unary=unary)
     if roll % 1 == 0:
@@ -153,12 +523,33 @@ async def do_roll(expression, session, character=None, output=[]):
 
     if character:
         output.append('{} rolled {}'.format(str(character), roll))
+        if record:
+            history.log.record(character.id, typed, roll)
+            for sides, faces in dice_rolled:
+                stats.tally.record(character.id, sides, faces)
     else:
         output.append('You rolled {}'.format(roll))
 
+    if detail is not None:
+        detail.extend(output)
+        for line, dice in described.items():
+            detail[line] = dice.describe(full=True)
+
     return roll
 
 
+async def send_roll(ctx, output, detail, author=True):
+    '''
+    Sends the output of a roll
+    Keeps the full output for `roll detail` if it had to be summarized or shortened
+    [author] whether to show the author of the command
+    '''
+    shown = fit(output)
+    if shown != detail:
+        details[ctx.author.id] = detail
+    await util.send_embed(ctx, author=author, description='\n'.join(shown))
+
+
 class RollCategory (util.Cog):
     @commands.group('roll', aliases=['r'], invoke_without_command=True)
     async def group(self, ctx, *, expression: str):
@@ -169,7 +560,7 @@ class RollCategory (util.Cog):
         Parameters:
         [expression*] standard dice notation specifying what to roll
             The expression may include saved rolls, replacing the name with the roll itself
-            Rolls may contain other rolls up to 3 levels deep
+            Rolls may contain other rolls, but not themselves
         [adv] (optional) roll any 1d20s with advantage or disadvantage for the following options:
             Advantage: `adv` | `advantage`
             Disadvantage: `dis` | `disadv` | `disadvantage`
@@ -178,6 +569,15 @@ class RollCategory (util.Cog):
 
         d : NdM rolls an M sided die N times and adds the results together
         g : NgM rolls an M sided die N times, rerolls any 1 or 2 once
+        kh: keeps the N highest dice of a roll i.e. 4d6kh3, `k` does the same
+        kl: keeps the N lowest dice of a roll i.e. 2d20kl1
+        dh: drops the N highest dice of a roll
+        dl: drops the N lowest dice of a roll i.e. 4d6dl1
+        r : rerolls dice of N or less once i.e. 2d6r2
+        ! : rolls another die for each die of N or more i.e. 3d6!5, a bare `!` explodes on the highest face
+            one roll explodes at most 100 extra dice
+        Operators of the same precedence apply left to right i.e. 4d6r1kh3
+        Rolls of more than 20 dice are shown as face×count, use `roll detail` to see every die
 
         > : picks larger operand
         < : picks smaller operand
@@ -209,13 +609,41 @@ class RollCategory (util.Cog):
             character = None
 
         output = []
-        await do_roll(expression, ctx.session, character, output=output)
-        await util.send_embed(ctx, description='\n'.join(output))
+        detail = []
+        server = ctx.guild.id if ctx.guild else None
+        await do_roll(expression, ctx.session, character, output=output, server=server, detail=detail)
+        await send_roll(ctx, output, detail)
+
+    @group.command(ignore_extra=False)
+    async def detail(self, ctx, page: int = 1):
+        '''
+        Shows every die of your last roll that was too large to show in full
+
+        Parameters:
+        [page] (optional) the page to show for rolls that take more than one
+        '''
+        lines = details.get(ctx.author.id)
+        if lines is None:
+            raise Exception('Your last roll was shown in full')
+
+        paginator = commands.Paginator(prefix='', suffix='', max_size=1900)
+        for line in lines:
+            for piece in wrap(line, 1800):
+                paginator.add_line(piece)
+        pages = paginator.pages
+        if not 1 <= page <= len(pages):
+            raise Exception('The roll only has {} pages'.format(len(pages)))
+
+        text = pages[page - 1]
+        if page < len(pages):
+            text += '\nUse `{}roll detail {}` to see the next page'.format(ctx.prefix, page + 1)
+        await util.send_embed(ctx, description=text)
 
     @group.command(aliases=['set', 'update'], ignore_extra=False)
     async def add(self, ctx, name: str, expression: str):
         '''
         Adds/updates a new roll for a character
+        Rolls that use themselves, directly or through other rolls, are rejected
 
         Parameters:
         [name] name of roll to store
@@ -223,16 +651,24 @@ class RollCategory (util.Cog):
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
+        # other rolls that use this one change with it
+        expressions = {roll.name: roll.expression for roll in character.rolls}
+        expressions[name] = expression
+        compiled = compile_rolls(expressions)
+        update_compiled(character.rolls, compiled)
+
         roll = util.sql_update(ctx.session, m.Roll, {
             'character': character,
             'name': name,
         }, {
             'expression': expression,
+            'compiled': compiled[name],
         })
 
         await util.send_embed(ctx, description='{} now has {}'.format(str(character), str(roll)))
 
     @group.command()
+    @util.read_only
     async def check(self, ctx, *, name: str):
         '''
         Checks the status of a roll
@@ -243,13 +679,11 @@ class RollCategory (util.Cog):
         name = util.strip_quotes(name)
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
-        roll = ctx.session.query(m.Roll)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if roll is None:
-            raise util.ItemNotFoundError(name)
+        roll = util.get_attribute(ctx.session, m.Roll, character, name)
         await util.send_embed(ctx, description=str(roll))
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def list(self, ctx):
         '''
         Lists all of a character's rolls
@@ -269,16 +703,15 @@ class RollCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        roll = ctx.session.query(m.Roll)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if roll is None:
-            raise util.ItemNotFoundError(name)
+        roll = util.delete_attribute(ctx.session, m.Roll, character, name)
 
-        ctx.session.delete(roll)
+        others = [other for other in character.rolls if other is not roll]
+        update_compiled(others, compile_rolls({other.name: other.expression for other in others}))
         ctx.session.commit()
         await util.send_embed(ctx, description='{} removed'.format(str(roll)))
 
     @group.command()
+    @util.read_only
     async def inspect(self, ctx, *, name: str):
         '''
         Lists the rolls for a specified character
@@ -290,6 +723,163 @@ class RollCategory (util.Cog):
 
         await util.inspector(ctx, name, 'rolls')
 
+    async def roll_characters(self, ctx, expression, names=None):
+        '''
+        Rolls an expression for the server's characters and sends the results highest first
+        [names] the names of the characters to roll for, None for all non-DM characters
+        '''
+        if not expression:
+            raise commands.MissingRequiredArgument('expression')
+        expression = util.strip_quotes(expression)
+
+        characters = ctx.session.query(m.Character)\
+            .options(selectinload(m.Character.rolls), selectinload(m.Character.variables))\
+            .filter_by(server=str(ctx.guild.id))
+        if names is None:
+            characters = characters.filter(~m.Character.dm_character)
+        else:
+            characters = characters.filter(m.Character.name.in_(names))
+        characters = characters.all()
+
+        if names is not None:
+            missing = set(names).difference(character.name for character in characters)
+            if missing:
+                raise Exception('No character named {}'.format(', '.join(sorted(missing))))
+        if not characters:
+            raise Exception('There are no characters on this server')
+
+        results = []
+        failures = []
+        for character in characters:
+            output = []
+            try:
+                roll = await do_roll(expression, ctx.session, character, output=output)
+            except equations.EquationError:
+                failures.append('{}: could not roll `{}`'.format(str(character), expression))
+                continue
+            # keep the individual dice, drop the expression steps and the total
+            dice = [line for line in output[:-1] if not line.startswith('`')]
+            results.append((roll, str(character), dice))
+        results.sort(key=lambda result: (-result[0], result[1]))
+
+        paginator = commands.Paginator(prefix='', suffix='')
+        paginator.add_line('`{}`'.format(expression))
+        for roll, name, dice in results:
+            line = '**{}**: {}'.format(name, roll)
+            if dice:
+                line += ' ({})'.format('; '.join(dice))
+            paginator.add_line(line)
+        for failure in failures:
+            paginator.add_line(failure)
+        await util.send_pages(ctx, paginator)
+
+    @group.command('all')
+    @commands.has_permissions(administrator=True)
+    async def all_(self, ctx, *, expression: str):
+        '''
+        Rolls the same expression for every character on the server
+        Saved rolls and variables are replaced separately for each character
+        Can only be done by an administrator
+
+        Parameters:
+        [expression*] standard dice notation specifying what to roll
+            the expression may include saved rolls and variables as in the `roll` command
+        '''
+        await self.roll_characters(ctx, expression)
+
+    @group.command()
+    @commands.has_permissions(administrator=True)
+    async def some(self, ctx, characters: str, *, expression: str):
+        '''
+        Rolls the same expression for a list of characters
+        Uses the same rules as the `roll all` command
+        Can only be done by an administrator
+
+        Parameters:
+        [characters] the names of the characters separated by commas, i.e. "Ann, Ben"
+        [expression*] standard dice notation specifying what to roll
+        '''
+        names = [name.strip() for name in characters.split(',') if name.strip()]
+        await self.roll_characters(ctx, expression, names)
+
+    @group.command(ignore_extra=False)
+    async def history(self, ctx, before: int = None):
+        '''
+        Shows a character's most recent rolls, newest first
+        Times are in UTC
+
+        Parameters:
+        [before] (optional) only show rolls older than this roll number
+        '''
+        page_size = 20
+        character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
+
+        records = ctx.session.query(m.RollRecord)\
+            .filter_by(character_id=character.id)
+        if before is not None:
+            records = records.filter(m.RollRecord.id < before)
+        records = records.order_by(m.RollRecord.id.desc()).limit(page_size + 1).all()
+        # rolls the background writer has not saved yet are newer than every saved roll, and have no number
+        unwritten = history.log.unwritten(character.id) if before is None else []
+        records = unwritten + records
+        if not records:
+            raise Exception('{} has no rolls to show'.format(str(character)))
+
+        paginator = commands.Paginator(prefix='', suffix='')
+        paginator.add_line("{}'s rolls:".format(str(character)))
+        for record in records[:page_size]:
+            if record.id is None:
+                paginator.add_line(str(record))
+            else:
+                paginator.add_line('#{} {}'.format(record.id, str(record)))
+        if len(unwritten) > page_size:
+            # unsaved rolls can only be paged through once they have numbers
+            paginator.add_line('{} more rolls are still being saved, use `{}roll history` again to see them'.format(
+                len(unwritten) - page_size, ctx.prefix))
+        elif len(records) > page_size:
+            paginator.add_line('Use `{}roll history {}` to see older rolls'.format(
+                ctx.prefix, records[page_size - 1].id))
+        await util.send_pages(ctx, paginator)
+
+    @group.command(ignore_extra=False)
+    async def luck(self, ctx, sides: int = 20):
+        '''
+        Checks whether a character's dice have been rolling fairly
+        Uses a chi-square test on every die of one size the character has rolled
+
+        Parameters:
+        [sides] (optional) the number of sides of the die, defaults to 20
+        '''
+        character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
+
+        row = ctx.session.query(m.RollStats).get((character.id, sides))
+        # include faces the background writer has not added yet
+        count, total, squares, histogram = stats.combined(row, stats.tally.faces(character.id, sides), sides)
+        if count == 0:
+            raise Exception('{} has not rolled any d{}s'.format(str(character), sides))
+
+        mean = total / count
+        deviation = math.sqrt(max(squares / count - mean ** 2, 0))
+        lines = [
+            '{} has rolled {} d{}s'.format(str(character), count, sides),
+            'Average: {:.2f} (a fair die averages {:.2f})'.format(mean, (sides + 1) / 2),
+            'Standard deviation: {:.2f} (a fair die has {:.2f})'.format(deviation, math.sqrt((sides ** 2 - 1) / 12)),
+        ]
+        if histogram is not None and sides > 1:
+            lines.append('Faces: ' + ', '.join('{}: {}'.format(face, n) for face, n in enumerate(histogram, 1)))
+            if count < 5 * sides:
+                lines.append('Roll at least {} times to check fairness'.format(5 * sides))
+            else:
+                chi2, p = stats.fairness(histogram)
+                if p < 0.01:
+                    verdict = 'This die is cursed'
+                elif p > 0.99:
+                    verdict = 'This die is suspiciously even'
+                else:
+                    verdict = 'This die looks fair'
+                lines.append('{} (chi-square {:.1f}, p = {:.3f})'.format(verdict, chi2, p))
+        await util.send_embed(ctx, description='\n'.join(lines))
+
     @commands.command(aliases=['r4'])
     @commands.has_permissions(administrator=True)
     async def rollfor(self, ctx, character: str, *, expression: str):
@@ -307,14 +897,14 @@ class RollCategory (util.Cog):
             raise commands.MissingRequiredArgument('expression')
         expression = util.strip_quotes(expression)
 
-        character = ctx.session.query(m.Character)\
-            .filter_by(name=character, server=str(ctx.guild.id)).one_or_none()
+        character = repository.get_named_character(ctx.session, character, ctx.guild.id)
         if character is None:
             raise Exception('Character does not exist')
 
         output = []
-        await do_roll(expression, ctx.session, character, output=output)
-        await util.send_embed(ctx, description='\n'.join(output))
+        detail = []
+        await do_roll(expression, ctx.session, character, output=output, detail=detail)
+        await send_roll(ctx, output, detail)
 
 
 def setup(bot):
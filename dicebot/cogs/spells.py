@@ -2,6 +2,7 @@ from discord.ext import commands
 from sqlalchemy.exc import IntegrityError
 
 from . import util
+from . import repository
 from .util import m
 
 
@@ -44,10 +45,7 @@ class SpellCategory (util.Cog):
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        spell = ctx.session.query(m.Spell)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if spell is None:
-            raise util.ItemNotFoundError(name)
+        spell = util.get_attribute(ctx.session, m.Spell, character, name)
 
         try:
             spell.name = new_name
@@ -70,10 +68,7 @@ class SpellCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        spell = ctx.session.query(m.Spell)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if spell is None:
-            raise util.ItemNotFoundError(name)
+        spell = util.get_attribute(ctx.session, m.Spell, character, name)
 
         spell.level = level
         ctx.session.commit()
@@ -93,10 +88,7 @@ class SpellCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        spell = ctx.session.query(m.Spell)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if spell is None:
-            raise util.ItemNotFoundError(name)
+        spell = util.get_attribute(ctx.session, m.Spell, character, name)
 
         spell.description = description
         ctx.session.commit()
@@ -115,6 +107,7 @@ class SpellCategory (util.Cog):
         await ctx.invoke(self.description, name, description=None)
 
     @group.command()
+    @util.read_only
     async def check(self, ctx, *, name: str):
         '''
         Checks the status of a spell
@@ -125,16 +118,14 @@ class SpellCategory (util.Cog):
         name = util.strip_quotes(name)
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
-        spell = ctx.session.query(m.Spell)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if spell is None:
-            raise util.ItemNotFoundError(name)
+        spell = util.get_attribute(ctx.session, m.Spell, character, name)
         text = '**{}**'.format(str(spell))
         if spell.description:
             text += '\n' + spell.description
         await util.send_embed(ctx, description=text)
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def list(self, ctx):
         '''
         Lists all of a character's spells
@@ -143,6 +134,7 @@ class SpellCategory (util.Cog):
         await util.inspector(ctx, character, 'spells', desc=True)
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def level(self, ctx, level: int):
         '''
         Lists all of a character's spells of a given level
@@ -151,14 +143,25 @@ class SpellCategory (util.Cog):
         [level] the level of spells to show
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
-        spells = ctx.session.query(m.Spell)\
-            .filter_by(character_id=character.id, level=level)\
-            .order_by(m.Spell.name).all()
+        spells = repository.list_attributes(ctx.session, m.Spell, character.id, level=level)
         text = ["{}'s spells:".format(character.name)]
         for spell in spells:
             text.append(str(spell))
         await util.send_embed(ctx, description='\n'.join(text))
 
+    @group.command(ignore_extra=False)
+    @util.read_only
+    async def search(self, ctx, query: str, page: int = 1):
+        '''
+        Searches the names and descriptions of a character's spells
+        Best matches are listed first
+
+        Parameters:
+        [query] the words to search for
+        [page] (optional) the page of results to show
+        '''
+        await util.searcher(ctx, m.Spell, query, page)
+
     @group.command(aliases=['delete'])
     async def remove(self, ctx, *, name: str):
         '''
@@ -171,16 +174,12 @@ class SpellCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        spell = ctx.session.query(m.Spell)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if spell is None:
-            raise util.ItemNotFoundError(name)
-
-        ctx.session.delete(spell)
+        spell = util.delete_attribute(ctx.session, m.Spell, character, name)
         ctx.session.commit()
         await util.send_embed(ctx, description='{} no longer has {}'.format(str(character), str(spell)))
 
     @group.command()
+    @util.read_only
     async def inspect(self, ctx, *, name: str):
         '''
         Lists the spells for a specified character
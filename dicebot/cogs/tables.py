@@ -1,9 +1,9 @@
 import re
-import random
 
 from discord.ext import commands
 
 from . import util
+from .. import rng
 
 table_expression = re.compile(r'^\s*(?:(\d+)\s*\|\s*)?(.*)\s*$')
 
@@ -34,7 +34,7 @@ class TableCategory (util.Cog):
                 options.extend([item] * count)
             else:
                 raise Exception('Misformatted item: {}'.format(line))
-        final = random.choice(options)
+        final = rng.get(ctx.guild.id if ctx.guild else None).choice(options)
         await util.send_embed(ctx, author=False, fields=[('Randomly chosen:', final)])
 
 
@@ -1,7 +1,34 @@
+import re
+import datetime
+
 from discord.ext import commands
 
 from . import util
 from .util import m
+from .. import clock
+
+# the longest a timer can run on the clock
+max_duration = datetime.timedelta(days=365)
+
+duration_units = {
+    'd': 24 * 60 * 60,
+    'h': 60 * 60,
+    'm': 60,
+    's': 1,
+}
+
+
+def parse_duration(text):
+    '''
+    Converts a duration such as 90s, 10m or 1h30m to seconds, a number without a unit is seconds
+    '''
+    text = text.strip().lower()
+    if text.isdigit():
+        return int(text)
+    parts = re.findall(r'(\d+)\s*([dhms])', text)
+    if not parts or re.sub(r'\d+\s*[dhms]\s*', '', text):
+        raise commands.BadArgument('Bad argument: duration')
+    return sum(int(number) * duration_units[unit] for number, unit in parts)
 
 
 class TimerCategory (util.Cog):
@@ -12,6 +39,7 @@ class TimerCategory (util.Cog):
 
         Timers help track values that change over time such as countdowns
         The timer changes by delta when `t tick` or `endturn` are used
+        Timers started with `t run` run out on the clock instead
         '''
         try:
             number, name = input.split(maxsplit=1)
@@ -37,6 +65,7 @@ class TimerCategory (util.Cog):
         }, {
             'initial': initial,
             'delta': delta,
+            'expires': None,
         })
 
         await util.send_embed(ctx, description='{} now has {}'.format(str(character), str(timer)))
@@ -54,18 +83,13 @@ class TimerCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        timer = ctx.session.query(m.Timer)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
+        timer = util.increment(ctx.session, m.Timer, character, name, 'value', number, m.Timer.value.isnot(None))
         if timer is None:
-            raise util.ItemNotFoundError(name)
-        if timer.value is None:
+            timer = util.get_attribute(ctx.session, m.Timer, character, name)
             raise Exception("{}'s {} is not running".format(str(character), timer.name))
 
-        prev = timer.value
-        timer.value = prev + number
-        ctx.session.commit()
         description = "{}'s {}: `{} => {}`".format(
-            str(character), timer.name, prev, timer.value)
+            str(character), timer.name, timer.value - number, timer.value)
         await util.send_embed(ctx, description=description)
 
     @group.command('-')
@@ -92,15 +116,13 @@ class TimerCategory (util.Cog):
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        timer = ctx.session.query(m.Timer)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if timer is None:
-            raise util.ItemNotFoundError(name)
+        timer = util.get_attribute(ctx.session, m.Timer, character, name)
 
         prev = timer.value
         if prev is None:
             prev = timer.initial
         timer.value = value
+        timer.expires = None
         ctx.session.commit()
 
         description = "{}'s {}: `{} => {}`".format(
@@ -114,17 +136,47 @@ class TimerCategory (util.Cog):
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        timer = ctx.session.query(m.Timer)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if timer is None:
-            raise util.ItemNotFoundError(name)
+        timer = util.get_attribute(ctx.session, m.Timer, character, name)
 
         timer.value = timer.initial
+        timer.expires = None
         ctx.session.commit()
 
         description = "{}'s {} started at {}".format(str(character), timer.name, timer.value)
         await util.send_embed(ctx, description=description)
 
+    @group.command()
+    async def run(self, ctx, duration: str, *, name: str):
+        '''
+        Starts a timer that runs out on the clock, such as a spell that lasts 10 minutes
+        This channel is told when it runs out
+        Adds the timer if the character does not have it
+        Parameters:
+        [duration] how long the timer runs, such as 90s, 10m or 1h30m
+        [name*] the name of the timer
+        '''
+        seconds = parse_duration(duration)
+        if not 0 < seconds <= max_duration.total_seconds():
+            raise commands.BadArgument('Bad argument: duration')
+        name = util.strip_quotes(name)
+
+        character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
+
+        expires = datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(seconds=seconds)
+        timer = util.sql_update(ctx.session, m.Timer, {
+            'character': character,
+            'name': name,
+        }, {
+            'initial': seconds,
+            'delta': -1,
+            'value': seconds,
+            'expires': expires,
+            'channel': str(ctx.channel.id),
+        })
+        clock.schedule(timer.id, timer.expires)
+
+        await util.send_embed(ctx, description='{} now has {}'.format(str(character), str(timer)))
+
     @group.command(ignore_extra=False)
     async def stop(self, ctx, *, name: str):
         '''
@@ -132,12 +184,10 @@ class TimerCategory (util.Cog):
         '''
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        timer = ctx.session.query(m.Timer)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if timer is None:
-            raise util.ItemNotFoundError(name)
+        timer = util.get_attribute(ctx.session, m.Timer, character, name)
 
         timer.value = None
+        timer.expires = None
         ctx.session.commit()
 
         description = "{}'s {} stopped".format(str(character), timer.name)
@@ -153,6 +203,7 @@ class TimerCategory (util.Cog):
         for timer in character.timers:
             if timer.value is not None:
                 timer.value = None
+            timer.expires = None
         ctx.session.commit()
 
         description = "All of {}'s timers are stopped".format(str(character))
@@ -168,7 +219,7 @@ class TimerCategory (util.Cog):
         description = ''
 
         for timer in character.timers:
-            if timer.value is not None:
+            if timer.value is not None and timer.expires is None:
                 prev = timer.value
                 timer.value += timer.delta
                 description += "{}'s {} ({:+}): `{} => {}`\n".format(
@@ -187,6 +238,7 @@ class TimerCategory (util.Cog):
         await ctx.invoke(self.tick)
 
     @group.command()
+    @util.read_only
     async def check(self, ctx, *, name: str):
         '''
         Checks the status of a timer
@@ -196,13 +248,11 @@ class TimerCategory (util.Cog):
         name = util.strip_quotes(name)
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
-        timer = ctx.session.query(m.Timer)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if timer is None:
-            raise util.ItemNotFoundError(name)
+        timer = util.get_attribute(ctx.session, m.Timer, character, name)
         await util.send_embed(ctx, description=str(timer))
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def list(self, ctx):
         '''
         Lists all of a character's timers
@@ -221,16 +271,12 @@ class TimerCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        timer = ctx.session.query(m.Timer)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if timer is None:
-            raise util.ItemNotFoundError(name)
-
-        ctx.session.delete(timer)
+        timer = util.delete_attribute(ctx.session, m.Timer, character, name)
         ctx.session.commit()
         await util.send_embed(ctx, description='{} removed'.format(str(timer)))
 
     @group.command()
+    @util.read_only
     async def inspect(self, ctx, *, name: str):
         '''
         Lists the timers for a specified character
@@ -1,7 +1,19 @@
+import time
+from collections import OrderedDict
+
 import discord
 from discord.ext import commands
 
-from .. import model as m
+from sqlalchemy import and_, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
+
+from .. import model as m  # noqa: F401, the cogs import the model from here
+from .. import changes
+from .. import names
+from .. import search
+from . import repository
 
 
 class BotError (Exception):
@@ -13,8 +25,9 @@ class NoCharacterError (BotError):
 
 
 class ItemNotFoundError (BotError):
-    def __init__(self, value=None):
+    def __init__(self, value=None, suggestions=()):
         self.value = value
+        self.suggestions = suggestions
 
 
 class Cog:
@@ -22,36 +35,221 @@ class Cog:
         self.bot = bot
 
 
+class LRUCache (OrderedDict):
+    '''
+    A dict that discards the least recently used entries past a maximum size
+    '''
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self:
+            self.hits += 1
+            self.move_to_end(key)
+            return self[key]
+        self.misses += 1
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.size:
+            self.popitem(last=False)
+
+
+class ExpiringSet:
+    '''
+    A set that forgets keys after ttl seconds, or sooner once it holds more than size keys
+    '''
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # keys in the order they expire
+        self.expires = OrderedDict()
+
+    def __len__(self):
+        return len(self.expires)
+
+    def __contains__(self, key):
+        expires = self.expires.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def add(self, key):
+        self.expires[key] = time.monotonic() + self.ttl
+        self.expires.move_to_end(key)
+        now = time.monotonic()
+        while self.expires and (len(self.expires) > self.size or next(iter(self.expires.values())) <= now):
+            self.expires.popitem(last=False)
+
+    def discard(self, key):
+        self.expires.pop(key, None)
+
+
+# rendered inspector pages keyed by (character id, attribute, desc, character version)
+rendered_pages = LRUCache(256)
+
+delete_emoji = '❌'
+
+# ids of the bot's messages that can be deleted with the delete emoji
+deletable = ExpiringSet(10000, 24 * 60 * 60)
+
+
+def read_only(command):
+    '''
+    Marks a command that only reads from the database so it can use the read replica
+    Goes below the command decorator, like the permission checks
+    '''
+    callback = command.callback if isinstance(command, commands.Command) else command
+    callback.__read_only__ = True
+    return command
+
+
+def is_read_only(command):
+    return command is not None and getattr(command.callback, '__read_only__', False)
+
+
 def get_character(session, userid, server):
     '''
     Gets a character based on their user
     '''
-    character = session.query(m.Character)\
-        .filter(~m.Character.dm_character)\
-        .filter_by(user=str(userid), server=str(server)).one_or_none()
+    character = repository.get_character(session, userid, server)
     if character is None:
         raise NoCharacterError()
     return character
 
 
+def get_attribute(session, type, character, name):
+    '''
+    Gets a character attribute by name
+    Raises ItemNotFoundError with the closest names if there is no exact match
+    '''
+    item = repository.get_attribute(session, type, character.id, name)
+    if item is None:
+        raise not_found(session, type, character, name)
+    return item
+
+
+def not_found(session, type, character, name):
+    '''
+    Makes the ItemNotFoundError for a missing attribute, with the closest names
+    '''
+    return ItemNotFoundError(name, names.suggest(session, type, character.id, name))
+
+
+def delete_attribute(session, type, character, name):
+    '''
+    Deletes a character attribute by name
+    Raises ItemNotFoundError with the closest names if there is no exact match
+    Returns the deleted attribute
+    '''
+    item = repository.delete_attribute(session, type, character.id, name)
+    if item is None:
+        raise not_found(session, type, character, name)
+    return item
+
+
+def increment(session, type, character, name, column, amount, *conditions):
+    '''
+    Adds an amount to a number column of a character's attribute with a single UPDATE and commits
+    Concurrent increments of the same row can't overwrite each other
+    [conditions] further conditions the row has to meet to be changed
+    Returns the changed row with all of its columns, None if no row was changed
+    '''
+    table = type.__table__
+    counter = table.c[column]
+    where = and_(table.c.character_id == character.id, table.c.name == name)
+    update = table.update().where(and_(where, *conditions)).values({counter: counter + amount})
+    if session.bind.dialect.implicit_returning:
+        row = session.execute(update.returning(*table.c)).first()
+    else:
+        # without RETURNING, read the row back in the same transaction that changed it
+        row = None
+        if session.execute(update).rowcount:
+            row = session.execute(select(list(table.c)).where(where)).first()
+    if row is not None:
+        changes.record(session, table.name, character.id)
+    session.commit()
+    return row
+
+
+# (index columns, updated columns) turns an INSERT into an upsert on SQLite
+# SQLAlchemy only has an insert construct with ON CONFLICT for Postgres
+Insert.argument_for('sqlite', 'on_conflict', None)
+
+
+@compiles(Insert, 'sqlite')
+def compile_sqlite_insert(insert, compiler, **kw):
+    sql = compiler.visit_insert(insert, **kw)
+    on_conflict = insert.dialect_options['sqlite']['on_conflict']
+    if on_conflict is not None:
+        index, columns = on_conflict
+        quote = compiler.preparer.quote
+        sql += ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            ', '.join(quote(column.name) for column in index),
+            ', '.join('{0} = excluded.{0}'.format(quote(column.name)) for column in columns))
+    return sql
+
+
+def column_values(type, values):
+    '''
+    Replaces the related objects in a dict of attribute values with their foreign keys
+    '''
+    columns = {}
+    for key, value in values.items():
+        relationship = type.__mapper__.relationships.get(key)
+        if relationship is None:
+            columns[key] = value
+        else:
+            for local, remote in relationship.local_remote_pairs:
+                columns[local.key] = getattr(value, remote.key)
+    return columns
+
+
 def sql_update(session, type, keys, values):
     '''
-    Updates a sql object
+    Updates a sql object, creating it if it does not exist, and commits
+    [keys] the columns of the unique index that identifies the object, relationships may be given as objects
+    [values] the columns to set
+    Uses a single INSERT ... ON CONFLICT DO UPDATE on Postgres and SQLite
+    Returns the object with all of its columns
     '''
-    obj = session.query(type)\
-        .filter_by(**keys).one_or_none()
-    if obj is not None:
-        for value in values:
-            setattr(obj, value, values[value])
+    table = type.__table__
+    dialect = session.bind.dialect
+    keys = column_values(type, keys)
+    values = column_values(type, values)
+    index = [table.c[key] for key in keys]
+    row = dict(keys, **values)
+
+    if dialect.name == 'postgresql':
+        upsert = postgresql.insert(table).values(row)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=index, set_={key: upsert.excluded[key] for key in values})
+        result = session.execute(upsert.returning(*table.c)).first()
+    elif dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 24):
+        session.execute(table.insert(sqlite_on_conflict=(index, [table.c[key] for key in values])).values(row))
+        # SQLite only returns rows from 3.35, read the row back in the same transaction
+        result = session.execute(select(list(table.c)).where(and_(*(column == keys[column.key] for column in index))))\
+            .first()
     else:
-        values = values.copy()
-        values.update(keys)
-        obj = type(**values)
-        session.add(obj)
+        obj = session.query(type)\
+            .filter_by(**keys).one_or_none()
+        if obj is not None:
+            for value in values:
+                setattr(obj, value, values[value])
+        else:
+            obj = type(**row)
+            session.add(obj)
+        session.commit()
+        return obj
 
+    # the name index only adds names it does not have yet, so this is right whether the row was new or not
+    changes.record(session, table.name, keys['character_id'], new=keys['name'])
     session.commit()
 
-    return obj
+    return type(**{column.key: result[column] for column in table.c})
 
 
 async def send_pages(ctx, paginator):
@@ -87,28 +285,72 @@ async def inspector(ctx, character, attr, desc=False):
     '''
     if isinstance(character, str):
         name = character
-        character = ctx.session.query(m.Character)\
-            .filter(~m.Character.dm_character)\
-            .filter_by(name=name, server=str(ctx.guild.id)).one_or_none()
+        character = repository.get_named_character(ctx.session, name, ctx.guild.id, players_only=True)
         if character is None:
             raise Exception('No character named {}'.format(name))
     else:
         name = character.name
 
+    key = (character.id, attr, desc, character.version)
+    pages = rendered_pages.get(key)
+    if pages is None:
+        paginator = commands.Paginator(prefix='', suffix='')
+        paginator.add_line("{}'s {}:".format(name, attr))
+        for item in getattr(character, attr):
+            head = str(item)
+            if desc:
+                head = '***{}***'.format(head)
+            paginator.add_line(head)
+            if desc and item.description:
+                for line in item.description.splitlines():
+                    paginator.add_line(line)
+        pages = rendered_pages[key] = paginator.pages
+
+    for page in pages:
+        await send_embed(ctx, description=page)
+
+
+async def searcher(ctx, type, query, page=1, page_size=10):
+    '''
+    Searches the descriptions of one of the user's character's attributes
+    [ctx] the command context
+    [type] the model of the attribute to search, must have a description
+    [query] the words to search for
+    [page] the page of results to show, starting from 1
+    '''
+    if page < 1:
+        raise commands.BadArgument('Bad argument: page')
+    character = get_character(ctx.session, ctx.author.id, ctx.guild.id)
+
+    # fetch one extra result to tell whether there is another page
+    items = search.search(ctx.session, type, character, query, limit=page_size + 1, offset=(page - 1) * page_size)
+
     paginator = commands.Paginator(prefix='', suffix='')
-    paginator.add_line("{}'s {}:".format(name, attr))
-    for item in getattr(character, attr):
-        head = str(item)
-        if desc:
-            head = '***{}***'.format(head)
-        paginator.add_line(head)
-        if desc and item.description:
-            for line in item.description.splitlines():
-                paginator.add_line(line)
+    paginator.add_line("{}'s {} matching `{}` (page {}):".format(character.name, type.__tablename__, query, page))
+    for item in items[:page_size]:
+        paginator.add_line('***{}***'.format(str(item)))
+        if item.description:
+            line = item.description.splitlines()[0]
+            if len(line) > 100:
+                line = line[:97] + '...'
+            paginator.add_line(line)
+    if not items:
+        paginator.add_line('No results')
+    elif len(items) > page_size:
+        paginator.add_line('Use `{}{} "{}" {}` to see more'.format(
+            ctx.prefix, ctx.command.qualified_name, query, page + 1))
 
     await send_pages(ctx, paginator)
 
 
+async def make_deletable(message):
+    '''
+    Lets anyone delete one of the bot's messages by reacting with the delete emoji
+    '''
+    await message.add_reaction(delete_emoji)
+    deletable.add(message.id)
+
+
 async def send_embed(ctx, *, content=None, author=True, description=None, fields=[]):
     '''
     Creates and sends an embed
@@ -33,6 +33,7 @@ class VariableCategory (util.Cog):
         await util.send_embed(ctx, description='{} now has {}'.format(str(character), str(variable)))
 
     @group.command()
+    @util.read_only
     async def check(self, ctx, *, name: str):
         '''
         Checks the status of a variable
@@ -43,13 +44,11 @@ class VariableCategory (util.Cog):
         name = util.strip_quotes(name)
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
-        variable = ctx.session.query(m.Variable)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if variable is None:
-            raise util.ItemNotFoundError(name)
+        variable = util.get_attribute(ctx.session, m.Variable, character, name)
         await util.send_embed(ctx, description=str(variable))
 
     @group.command(ignore_extra=False)
+    @util.read_only
     async def list(self, ctx):
         '''
         Lists all of a character's variables
@@ -69,16 +68,12 @@ class VariableCategory (util.Cog):
 
         character = util.get_character(ctx.session, ctx.author.id, ctx.guild.id)
 
-        variable = ctx.session.query(m.Variable)\
-            .filter_by(character_id=character.id, name=name).one_or_none()
-        if variable is None:
-            raise util.ItemNotFoundError(name)
-
-        ctx.session.delete(variable)
+        variable = util.delete_attribute(ctx.session, m.Variable, character, name)
         ctx.session.commit()
         await util.send_embed(ctx, description='{} no longer has {}'.format(str(character), str(variable)))
 
     @group.command()
+    @util.read_only
     async def inspect(self, ctx, *, name: str):
         '''
         Lists the variables for a specified character
@@ -0,0 +1,97 @@
+'''
+Decides from the text of a message alone whether it could be a command
+
+Messages that don't start with the server's prefix or mention the bot are dropped
+before a context is built or a database session is opened
+The prefixes and the blacklist are cached in memory,
+prefixes follow committed changes and the blacklist, which is edited in the database directly, is reloaded periodically
+'''
+
+import re
+import asyncio
+import logging
+from collections import Counter
+from contextlib import closing
+
+from . import model as m
+from . import changes
+
+logger = logging.getLogger(__name__)
+
+# prefixes of the servers that don't use the default
+prefixes = {}
+
+# ids of the users that may not use the bot
+blacklist = set()
+
+# matches a mention of the bot and the rest of the line after it, set by `set_user`
+mention = None
+
+# messages by outcome: rejected, blacklisted or dispatched
+counts = Counter()
+
+session_factory = None
+
+
+def load(Session):
+    '''
+    Loads the prefixes and blacklist
+    [Session] the session factory, kept to reload them later
+    '''
+    global session_factory
+    session_factory = Session
+    with closing(Session()) as session:
+        loaded_prefixes = session.query(m.Prefix.server, m.Prefix.prefix).all()
+        loaded_blacklist = {id for id, in session.query(m.Blacklist.id)}
+    prefixes.clear()
+    prefixes.update(loaded_prefixes)
+    blacklist.clear()
+    blacklist.update(loaded_blacklist)
+
+
+def set_user(user):
+    '''
+    Compiles the mention pattern for the bot's user
+    Covers both the plain and the nickname form of the mention, so one pattern works in every server
+    '''
+    global mention
+    mention = re.compile(r'<@!?{}>\s*(.*)(?=\n|$)'.format(user.id))
+
+
+def candidate(message, prefix):
+    '''
+    Whether a message could be a command
+    '''
+    content = message.content
+    if content.startswith(prefix) or (mention is not None and mention.search(content)):
+        return True
+    counts['rejected'] += 1
+    return False
+
+
+async def refresh(interval=60):
+    '''
+    Reloads the prefixes and blacklist every interval seconds
+    '''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            load(session_factory)
+        except Exception:
+            logger.exception('Could not reload prefixes and blacklist')
+
+
+@changes.subscribe
+def apply(committed):
+    for change in committed:
+        if change.table == m.Prefix.__tablename__:
+            if change.new is None:
+                prefixes.pop(change.key, None)
+            else:
+                prefixes[change.key] = change.new
+
+
+@changes.on_reset
+def reset():
+    if session_factory is not None:
+        load(session_factory)
@@ -0,0 +1,94 @@
+'''
+Log of the rolls made by characters
+
+do_roll appends each roll to an in-memory ring buffer,
+a background task writes the buffer to the roll_history table in batches
+so a roll never waits on the database
+Rows older than the retention period are deleted periodically
+'''
+
+import asyncio
+import logging
+import datetime
+from collections import deque
+from contextlib import closing
+
+from . import model as m
+
+logger = logging.getLogger(__name__)
+
+
+class RollLog:
+    '''
+    Buffers rolls until they are written to the database
+    If the writer falls behind, the oldest unwritten rolls are dropped
+    '''
+    def __init__(self, size=10000):
+        self.pending = deque(maxlen=size)
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def record(self, character_id, expression, result):
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append({
+            'character_id': character_id,
+            'expression': expression[:m.RollRecord.expression.type.length],
+            'result': str(result)[:m.RollRecord.result.type.length],
+            'time': datetime.datetime.utcnow(),
+        })
+
+    def unwritten(self, character_id):
+        '''
+        Gets a character's rolls that are not written yet, newest first
+        '''
+        return [m.RollRecord(**row) for row in reversed(self.pending) if row['character_id'] == character_id]
+
+    def flush(self, session):
+        '''
+        Writes all buffered rolls in one batch
+        '''
+        if not self.pending:
+            return
+        rows = list(self.pending)
+        self.pending.clear()
+        try:
+            session.execute(m.RollRecord.__table__.insert(), rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            # put the rolls back for the next attempt, newer rolls may push some out
+            self.pending.extendleft(reversed(rows))
+            raise
+
+    def prune(self, session, days):
+        '''
+        Deletes rolls older than a number of days
+        '''
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        session.query(m.RollRecord)\
+            .filter(m.RollRecord.time < cutoff).delete(synchronize_session=False)
+        session.commit()
+
+    async def run(self, Session, interval=5, retention=90, prune_every=3600):
+        '''
+        Writes buffered rolls every interval seconds
+        Deletes rolls older than retention days every prune_every seconds
+        '''
+        elapsed = prune_every
+        while True:
+            await asyncio.sleep(interval)
+            elapsed += interval
+            try:
+                with closing(Session()) as session:
+                    self.flush(session)
+                    if elapsed >= prune_every:
+                        self.prune(session, retention)
+                        elapsed = 0
+            except Exception:
+                logger.exception('Could not write roll history')
+
+
+log = RollLog()
@@ -0,0 +1,195 @@
+'''
+Local HTTP endpoint for health checks and metrics
+
+Serves on 127.0.0.1 at the port in the metrics_port config key, it is not started if the key is empty
+    /healthz: whether the bot is connected and responsive, as JSON
+    /metrics: command latencies, database pool use and cache hit rates in the Prometheus text format
+    /debug/tasks: the pending asyncio tasks
+'''
+
+import sys
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from aiohttp import web
+from sqlalchemy.pool import QueuePool
+
+from . import names
+from . import dispatch
+from .cogs import util, rolls
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the command latency histogram buckets, in seconds
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# the most event loop lag, in seconds, before /healthz reports the bot as unresponsive
+max_lag = 1
+
+# how often the event loop lag is measured, in seconds
+lag_interval = 1
+
+
+class Histogram:
+    '''
+    Counts observations into cumulative buckets like a Prometheus histogram
+    '''
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+# latency histograms keyed by qualified command name
+latencies = OrderedDict()
+
+# the most recent measurement of how late the event loop runs a callback, in seconds
+lag = 0
+
+
+def command_started(ctx):
+    ctx.started = time.perf_counter()
+
+
+def command_finished(ctx):
+    started = getattr(ctx, 'started', None)
+    if started is None or ctx.command is None:
+        return
+    histogram = latencies.get(ctx.command.qualified_name)
+    if histogram is None:
+        histogram = latencies[ctx.command.qualified_name] = Histogram()
+    histogram.observe(time.perf_counter() - started)
+
+
+def caches():
+    '''
+    Gets the name, hits, misses and size of every cache
+    '''
+    yield 'rendered_pages', util.rendered_pages.hits, util.rendered_pages.misses, len(util.rendered_pages)
+    yield 'name_indexes', names.indexes.hits, names.indexes.misses, len(names.indexes)
+    yield 'roll_details', rolls.details.hits, rolls.details.misses, len(rolls.details)
+    info = rolls.name_pattern.cache_info()
+    yield 'name_patterns', info.hits, info.misses, info.currsize
+
+
+def all_tasks(loop):
+    if sys.version_info >= (3, 7):
+        return asyncio.all_tasks(loop)
+    return asyncio.Task.all_tasks(loop)
+
+
+async def measure_lag(loop):
+    '''
+    Measures how much later than scheduled the event loop wakes up a sleeping task
+    '''
+    global lag
+    while True:
+        start = loop.time()
+        await asyncio.sleep(lag_interval)
+        lag = max(loop.time() - start - lag_interval, 0)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Server:
+    def __init__(self, bot, engine):
+        self.bot = bot
+        self.engine = engine
+
+    async def healthz(self, request):
+        ready = self.bot.is_ready() and not self.bot.is_closed()
+        healthy = ready and lag < max_lag
+        latency = self.bot.latency
+        body = {
+            'ready': ready,
+            # NaN until the gateway connects, which JSON cannot represent
+            'latency': None if math.isnan(latency) else latency,
+            'loop_lag': lag,
+            'guilds': len(self.bot.guilds),
+        }
+        return web.json_response(body, status=200 if healthy else 503)
+
+    async def metrics(self, request):
+        lines = []
+
+        def metric(name, type, help, samples):
+            '''
+            Adds a metric family, samples are (name suffix, label pairs, value)
+            '''
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+            for suffix, labels, value in samples:
+                if labels:
+                    labels = '{' + ','.join('{}="{}"'.format(key, escape(label)) for key, label in labels) + '}'
+                lines.append('{}{}{} {}'.format(name, suffix, labels or '', value))
+
+        samples = []
+        for command, histogram in latencies.items():
+            for bound, count in zip(buckets, histogram.counts):
+                samples.append(('_bucket', (('command', command), ('le', bound)), count))
+            samples.append(('_bucket', (('command', command), ('le', '+Inf')), histogram.count))
+            samples.append(('_sum', (('command', command),), histogram.sum))
+            samples.append(('_count', (('command', command),), histogram.count))
+        metric('dicebot_command_duration_seconds', 'histogram', 'Time taken to run commands', samples)
+
+        pool = self.engine.pool
+        # only queue pools, which every database but SQLite uses, count their connections
+        if isinstance(pool, QueuePool):
+            metric('dicebot_db_pool_checked_out', 'gauge', 'Database connections in use', [
+                ('', (), pool.checkedout())])
+            metric('dicebot_db_pool_size', 'gauge', 'Database connections the pool keeps', [
+                ('', (), pool.size())])
+
+        stats = list(caches())
+        metric('dicebot_cache_hits_total', 'counter', 'Cache lookups that found an entry', [
+            ('', (('cache', name),), hits) for name, hits, misses, size in stats])
+        metric('dicebot_cache_misses_total', 'counter', 'Cache lookups that found nothing', [
+            ('', (('cache', name),), misses) for name, hits, misses, size in stats])
+        metric('dicebot_cache_entries', 'gauge', 'Entries in the cache', [
+            ('', (('cache', name),), size) for name, hits, misses, size in stats])
+
+        metric('dicebot_messages_total', 'counter', 'Messages seen, by whether they were dispatched as commands', [
+            ('', (('result', result),), count) for result, count in sorted(dispatch.counts.items())])
+
+        metric('dicebot_event_loop_lag_seconds', 'gauge', 'How late the event loop last woke a sleeping task', [
+            ('', (), lag)])
+        metric('dicebot_gateway_latency_seconds', 'gauge', 'Websocket heartbeat latency', [
+            ('', (), self.bot.latency)])
+
+        return web.Response(text='\n'.join(lines) + '\n', content_type='text/plain', charset='utf-8')
+
+    async def tasks(self, request):
+        lines = sorted(map(repr, all_tasks(asyncio.get_event_loop())))
+        lines.insert(0, '{} tasks'.format(len(lines)))
+        return web.Response(text='\n'.join(lines) + '\n')
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_get('/healthz', self.healthz)
+        app.router.add_get('/metrics', self.metrics)
+        app.router.add_get('/debug/tasks', self.tasks)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', port)
+        await site.start()
+        logger.info('Serving metrics on port %s', port)
+
+
+def setup(bot, engine, port):
+    '''
+    Starts the metrics server on a local port
+    '''
+    bot.loop.create_task(measure_lag(bot.loop))
+    bot.loop.create_task(Server(bot, engine).start(port))
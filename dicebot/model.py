@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import enum
+import hashlib
 
 from sqlalchemy import (
     Column,
@@ -10,7 +11,13 @@ from sqlalchemy import (
     Boolean,
     Enum,
     ForeignKey,
+    DateTime,
+    LargeBinary,
+    func,
+    inspect,
+    select,
 )
+from sqlalchemy.exc import DatabaseError
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Index, UniqueConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -18,6 +25,9 @@ from sqlalchemy.ext.declarative import declarative_base
 
 dmkey = 'DM'
 
+# SQLite only autoincrements INTEGER primary keys
+Id = BigInteger().with_variant(Integer, 'sqlite')
+
 
 class Base:
     def dict(self):
@@ -61,6 +71,23 @@ class Prefix (Base):
         doc='The prefix for the server')
 
 
+class RandomSource (Base):
+    '''
+    Stores the random number source chosen by servers
+    Servers without an entry use the default source
+    '''
+    __tablename__ = 'random_sources'
+
+    server = Column(
+        String(64),
+        primary_key=True,
+        doc='The server id')
+    source = Column(
+        String(64),
+        nullable=False,
+        doc='The name of the random number source')
+
+
 class Character (Base):
     '''
     Character data
@@ -68,7 +95,7 @@ class Character (Base):
     __tablename__ = 'characters'
 
     id = Column(
-        BigInteger,
+        Id,
         primary_key=True,
         doc='An autonumber id')
     name = Column(
@@ -82,6 +109,10 @@ class Character (Base):
     user = Column(
         String(64),
         doc='The id of the user of the character')
+    version = Column(
+        Integer,
+        nullable=False, default=0, server_default='0',
+        doc='Incremented whenever the character or one of its attributes changes')
 
     @hybrid_property
     def dm_character(self):
@@ -150,7 +181,7 @@ class Resource (Base):
     __tablename__ = 'resources'
 
     id = Column(
-        BigInteger,
+        Id,
         primary_key=True,
         doc='An autonumber id')
     character_id = Column(
@@ -198,7 +229,7 @@ class Roll (Base):
     __tablename__ = 'rolls'
 
     id = Column(
-        BigInteger,
+        Id,
         primary_key=True,
         doc='An autonumber id')
     character_id = Column(
@@ -213,6 +244,9 @@ class Roll (Base):
     expression = Column(
         String,
         doc='The dice expression to roll')
+    compiled = Column(
+        String,
+        doc='The expression with the saved rolls it uses expanded and constant parts worked out')
     group = Column(
         String,
         doc='Group to display the roll with on website')
@@ -237,7 +271,7 @@ class Variable (Base):
     __tablename__ = 'variables'
 
     id = Column(
-        BigInteger,
+        Id,
         primary_key=True,
         doc='An autonumber id')
     character_id = Column(
@@ -274,7 +308,7 @@ class Item (Base):
     __tablename__ = 'items'
 
     id = Column(
-        BigInteger,
+        Id,
         primary_key=True,
         doc='An autonumber id')
     character_id = Column(
@@ -315,7 +349,7 @@ class Spell (Base):
     __tablename__ = 'spells'
 
     id = Column(
-        BigInteger,
+        Id,
         primary_key=True,
         doc='An autonumber id')
     character_id = Column(
@@ -360,7 +394,7 @@ class Information (Base):
     __tablename__ = 'information'
 
     id = Column(
-        BigInteger,
+        Id,
         primary_key=True,
         doc='An autonumber id')
     character_id = Column(
@@ -401,7 +435,7 @@ class Timer (Base):
     __tablename__ = 'timers'
 
     id = Column(
-        BigInteger,
+        Id,
         primary_key=True,
         doc='An autonumber id')
     character_id = Column(
@@ -424,6 +458,12 @@ class Timer (Base):
     value = Column(
         Integer,
         doc='The current value of the timer, null for not running')
+    expires = Column(
+        DateTime,
+        doc='When the timer runs out on the clock, null for timers that only change on ticks')
+    channel = Column(
+        String(64),
+        doc='The channel told when the timer runs out on the clock')
 
     __table_args__ = (
         Index('_timer_index', character_id, name, unique=True),
@@ -435,11 +475,163 @@ class Timer (Base):
         back_populates='timers')
 
     def __str__(self):
+        if self.expires is not None:
+            return '{0.name}: runs out at {0.expires:%Y-%m-%d %H:%M:%S} UTC'.format(self)
         ret = '{0.name} ({0.initial}, {0.delta:+}): {1}'.format(
             self, self.value if self.value is not None else 'stopped')
         return ret
 
 
+class RollRecord (Base):
+    '''
+    Log of the rolls made by characters
+    Written in batches by a background task
+    '''
+    __tablename__ = 'roll_history'
+
+    id = Column(
+        Id,
+        primary_key=True,
+        doc='An autonumber id, increasing in roll order')
+    # not a foreign key: rows are written after the roll and the character may be gone by then
+    character_id = Column(
+        BigInteger,
+        nullable=False,
+        doc='The id of the character that rolled')
+    expression = Column(
+        String(256),
+        nullable=False,
+        doc='The expression as it was typed')
+    result = Column(
+        String(32),
+        nullable=False,
+        doc='The result of the roll')
+    time = Column(
+        DateTime,
+        nullable=False,
+        doc='When the roll was made, in UTC')
+
+    __table_args__ = (
+        Index('_roll_history_index', character_id, id),
+    )
+
+    def __str__(self):
+        return '{0.time:%Y-%m-%d %H:%M} `{0.expression}` = {0.result}'.format(self)
+
+
+class RollStats (Base):
+    '''
+    Running totals of the dice a character has rolled, per die size
+    Written in batches by a background task
+    '''
+    __tablename__ = 'roll_stats'
+
+    # not a foreign key for the same reason as the roll history
+    character_id = Column(
+        BigInteger,
+        primary_key=True,
+        doc='The id of the character that rolled')
+    sides = Column(
+        Integer,
+        primary_key=True,
+        doc='The number of sides of the die')
+    count = Column(
+        BigInteger,
+        nullable=False,
+        default=0,
+        doc='The number of dice rolled')
+    total = Column(
+        BigInteger,
+        nullable=False,
+        default=0,
+        doc='The sum of the faces rolled')
+    squares = Column(
+        BigInteger,
+        nullable=False,
+        default=0,
+        doc='The sum of the squares of the faces rolled')
+    histogram = Column(
+        String,
+        doc='JSON list of how many times each face was rolled, lowest face first, only kept for small dice')
+
+
+class Encounter (Base):
+    '''
+    A fight in a channel, tracks the initiative order
+    '''
+    __tablename__ = 'encounters'
+
+    id = Column(
+        Id,
+        primary_key=True,
+        doc='An autonumber id')
+    server = Column(
+        String(64),
+        nullable=False,
+        doc='The server the encounter is on')
+    channel = Column(
+        String(64),
+        nullable=False, unique=True,
+        doc='The channel the encounter is in')
+    round = Column(
+        Integer,
+        nullable=False, default=1,
+        doc='The current round')
+    turn = Column(
+        BigInteger,
+        doc='The id of the combatant whose turn it is, null before the first turn')
+
+    combatants = relationship(
+        'Combatant',
+        order_by='Combatant.initiative.desc(),Combatant.id',
+        back_populates='encounter')
+
+
+class Combatant (Base):
+    '''
+    A participant in an encounter
+    '''
+    __tablename__ = 'combatants'
+
+    id = Column(
+        Id,
+        primary_key=True,
+        doc='An autonumber id')
+    encounter_id = Column(
+        BigInteger,
+        ForeignKey('encounters.id'),
+        nullable=False,
+        doc='Encounter foreign key')
+    name = Column(
+        String(64),
+        nullable=False,
+        doc='The name shown in the initiative order')
+    character_id = Column(
+        BigInteger,
+        ForeignKey('characters.id'),
+        doc='Character foreign key, null for combatants without a character')
+    initiative = Column(
+        Integer,
+        nullable=False,
+        doc='The initiative roll, higher goes first')
+
+    __table_args__ = (
+        UniqueConstraint(encounter_id, name),
+        Index('_combatant_index', encounter_id, initiative),
+    )
+
+    encounter = relationship(
+        'Encounter',
+        foreign_keys=[encounter_id],
+        back_populates='combatants')
+    character = relationship(
+        'Character',
+        foreign_keys=[character_id])
+
+    def __str__(self):
+        return '{0.initiative}: {0.name}'.format(self)
+
+
 class Blacklist (Base):
     '''
     A list of user ids that are not allowed to use the dice bot
@@ -452,6 +644,143 @@ class Blacklist (Base):
         doc='The id of the blacklisted user')
 
 
+class Notification (Base):
+    '''
+    Changes published for other bot processes sharing the database
+    Only used when the database has no native notification mechanism
+    '''
+    __tablename__ = 'notifications'
+
+    id = Column(
+        Id,
+        primary_key=True,
+        doc='An autonumber id, increasing in publication order')
+    sender = Column(
+        String(32),
+        nullable=False,
+        doc='The id of the process that published the changes')
+    payload = Column(
+        String,
+        nullable=False,
+        doc='The published changes as JSON')
+    created = Column(
+        DateTime,
+        nullable=False, default=func.now(),
+        doc='When the changes were published')
+
+
+class ServerActivity (Base):
+    '''
+    When each server last used the bot
+    Written at most once an hour per server
+    '''
+    __tablename__ = 'server_activity'
+
+    server = Column(
+        String(64),
+        primary_key=True,
+        doc='The server id')
+    last_used = Column(
+        DateTime,
+        nullable=False,
+        doc='When a command was last used on the server')
+
+
+class ServerArchive (Base):
+    '''
+    The characters and encounters of a server that has not used the bot for a long time
+    Moved back into their tables when the server uses the bot again
+    '''
+    __tablename__ = 'server_archives'
+
+    server = Column(
+        String(64),
+        primary_key=True,
+        doc='The server id')
+    archived = Column(
+        DateTime,
+        nullable=False,
+        doc='When the server was archived')
+    data = Column(
+        LargeBinary,
+        nullable=False,
+        doc='The rows of the server as zlib compressed JSON, lists of rows by table name')
+
+
+class SchemaVersion (Base):
+    '''
+    The version of the schema the database was last set up for
+    Tables and columns are only created on startup when the version changes
+    '''
+    __tablename__ = 'schema_version'
+
+    version = Column(
+        String(64),
+        primary_key=True,
+        doc='A hash of the tables, columns and indexes')
+    applied = Column(
+        DateTime,
+        nullable=False, default=func.now(),
+        doc='When the database was set up for this version')
+
+
+def schema_version(*extra):
+    '''
+    Gets the version of the schema, a hash that changes whenever a table, column or index does
+    [extra] other statements the database is set up with, such as for search indexes
+    '''
+    parts = list(extra)
+    for table in Base.metadata.sorted_tables:
+        parts.append(table.name)
+        for column in table.columns:
+            default = None if column.server_default is None else column.server_default.arg
+            parts.append('{} {} {} {}'.format(column.name, column.type, column.nullable, default))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            parts.append('{} {} {}'.format(index.name, index.unique, [column.name for column in index.columns]))
+        parts.extend(sorted(
+            '{} {}'.format(type(constraint).__name__, [column.name for column in constraint.columns])
+            for constraint in table.constraints))
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+def stored_schema_version(engine):
+    '''
+    Gets the version of the schema the database was last set up for, None if it never was
+    '''
+    try:
+        return engine.execute(select([SchemaVersion.version])).scalar()
+    except DatabaseError:
+        # the version table does not exist yet
+        return None
+
+
+def store_schema_version(engine, version):
+    with engine.begin() as connection:
+        connection.execute(SchemaVersion.__table__.delete())
+        connection.execute(SchemaVersion.__table__.insert().values(version=version))
+
+
+def add_missing_columns(engine):
+    '''
+    Adds columns that are missing from existing tables
+    New columns must be nullable or have a server default
+    '''
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            sql = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+                quote(table.name), quote(column.name), column.type.compile(engine.dialect))
+            if column.server_default is not None:
+                sql += " DEFAULT '{}'".format(column.server_default.arg)
+            if not column.nullable:
+                sql += ' NOT NULL'
+            engine.execute(sql)
+
+
 if __name__ == '__main__':
     from operator import attrgetter
 
@@ -0,0 +1,119 @@
+'''
+In-memory trigram indexes over the names of character attributes
+Used to suggest the closest names when a lookup by name misses
+'''
+
+from collections import OrderedDict
+from difflib import SequenceMatcher
+
+from . import changes
+
+
+def trigrams(name):
+    '''
+    Gets the set of case insensitive trigrams for a name
+    '''
+    name = '  {} '.format(name.lower())
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+class NameIndex:
+    '''
+    Trigram index over the names of one attribute of one character
+    '''
+    def __init__(self, names=()):
+        self.names = set()
+        self.grams = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        self.names.add(name)
+        for gram in trigrams(name):
+            self.grams.setdefault(gram, set()).add(name)
+
+    def remove(self, name):
+        if name not in self.names:
+            return
+        self.names.remove(name)
+        for gram in trigrams(name):
+            names = self.grams.get(gram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.grams[gram]
+
+    def suggest(self, name, limit=3, threshold=0.6):
+        '''
+        Gets up to limit names ordered by similarity to name
+        Only names sharing at least one trigram with name are compared
+        '''
+        candidates = set()
+        for gram in trigrams(name):
+            candidates.update(self.grams.get(gram, ()))
+        matcher = SequenceMatcher(b=name.lower())
+        scored = []
+        for candidate in candidates:
+            matcher.set_seq1(candidate.lower())
+            score = matcher.ratio()
+            if score >= threshold:
+                scored.append((-score, candidate))
+        scored.sort()
+        return [candidate for score, candidate in scored[:limit]]
+
+
+class NameIndexes:
+    '''
+    Bounded cache of name indexes keyed by table and character id
+    Indexes are built from the database on first use and kept up to date from committed changes
+    '''
+    def __init__(self, size=1024):
+        self.size = size
+        self.indexes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def get(self, session, type, character_id):
+        key = (type.__tablename__, character_id)
+        index = self.indexes.get(key)
+        if index is None:
+            self.misses += 1
+            names = session.query(type.name).filter_by(character_id=character_id)
+            index = NameIndex(name for name, in names)
+            self.indexes[key] = index
+            if len(self.indexes) > self.size:
+                self.indexes.popitem(last=False)
+        else:
+            self.hits += 1
+            self.indexes.move_to_end(key)
+        return index
+
+    def apply(self, changes):
+        for change in changes:
+            index = self.indexes.get((change.table, change.key))
+            if index is not None and change.old != change.new:
+                if change.old is not None:
+                    index.remove(change.old)
+                if change.new is not None:
+                    index.add(change.new)
+
+    def clear(self):
+        self.indexes.clear()
+
+
+indexes = NameIndexes()
+changes.subscribe(indexes.apply)
+changes.on_reset(indexes.clear)
+
+
+def suggest(session, type, character_id, name, limit=3):
+    '''
+    Gets the names of a character's attributes closest to name
+    '''
+    return indexes.get(session, type, character_id).suggest(name, limit=limit)
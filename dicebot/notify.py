@@ -0,0 +1,194 @@
+'''
+Shares committed changes between bot processes using the same database
+
+Changes are published inside the committing transaction,
+so other processes only ever see changes that were committed
+PostgreSQL delivers them with LISTEN/NOTIFY,
+other databases store them in the notifications table which every process polls
+Received changes are passed to the subscribers of the changes module
+'''
+
+import json
+import asyncio
+import logging
+from uuid import uuid4
+
+from sqlalchemy import event, select, func, and_
+from sqlalchemy.orm import Session
+
+from . import model as m
+from . import changes
+
+logger = logging.getLogger(__name__)
+
+# identifies this process so it can skip its own notifications
+sender = uuid4().hex
+
+# the largest payload sent in one notification, PostgreSQL's limit is 8000 bytes
+max_payload = 7900
+
+transport = None
+
+
+def encode(batch):
+    return json.dumps({'sender': sender, 'changes': [list(change) for change in batch]})
+
+
+def payloads(pending):
+    '''
+    Encodes changes into as few payloads of at most max_payload bytes as fit them
+    If a change is too large for a payload of its own, every process is told to reset instead
+    '''
+    # json.dumps escapes everything outside ASCII, so the length in characters is the length in bytes
+    overhead = len(encode([]))
+    # each change with the comma separating it from the previous one
+    sizes = [len(json.dumps(list(change))) + 2 for change in pending]
+    if overhead + max(sizes) > max_payload:
+        return [json.dumps({'sender': sender, 'reset': True})]
+
+    encoded = []
+    start = 0
+    size = overhead
+    for i, change_size in enumerate(sizes):
+        if size + change_size > max_payload:
+            encoded.append(encode(pending[start:i]))
+            start = i
+            size = overhead
+        size += change_size
+    encoded.append(encode(pending[start:]))
+    return encoded
+
+
+def deliver(payload):
+    '''
+    Passes changes published by other processes to the local subscribers
+    '''
+    data = json.loads(payload)
+    if data['sender'] == sender:
+        return
+    if data.get('reset'):
+        changes.reset()
+    else:
+        changes.publish([changes.Change(*change) for change in data['changes']])
+
+
+class PostgresTransport:
+    '''
+    Publishes changes with NOTIFY and receives them on a dedicated LISTEN connection
+    '''
+    channel = 'dicebot_changes'
+
+    def __init__(self, engine, interval):
+        self.engine = engine
+        self.interval = interval
+
+    def publish(self, session, payload):
+        session.execute(select([func.pg_notify(self.channel, payload)]))
+
+    def connect(self):
+        connection = self.engine.raw_connection()
+        connection.detach()
+        connection = connection.connection
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('LISTEN {}'.format(self.channel))
+        return connection
+
+    async def listen(self, loop):
+        while True:
+            try:
+                connection = self.connect()
+            except Exception:
+                logger.exception('Could not listen for changes')
+                await asyncio.sleep(self.interval)
+                continue
+
+            # anything could have changed while nobody was listening
+            changes.reset()
+            ready = asyncio.Event()
+            loop.add_reader(connection.fileno(), ready.set)
+            try:
+                while True:
+                    try:
+                        await asyncio.wait_for(ready.wait(), self.interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    ready.clear()
+                    # also notices a lost connection when nothing arrives
+                    connection.poll()
+                    while connection.notifies:
+                        deliver(connection.notifies.pop(0).payload)
+            except Exception:
+                logger.exception('Lost connection listening for changes')
+            finally:
+                loop.remove_reader(connection.fileno())
+                connection.close()
+
+
+class PollingTransport:
+    '''
+    Stores changes in the notifications table and polls it for new rows
+    Relies on commits being serialized, as they are on SQLite,
+    so rows always become visible in id order
+    '''
+    def __init__(self, engine, interval, prune_every=300):
+        self.engine = engine
+        self.interval = interval
+        self.prune_every = prune_every
+
+    def publish(self, session, payload):
+        session.execute(m.Notification.__table__.insert().values(sender=sender, payload=payload))
+
+    async def listen(self, loop):
+        table = m.Notification.__table__
+        last = self.engine.execute(select([func.max(table.c.id)])).scalar() or 0
+        prune_below = last
+        polls = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                rows = self.engine.execute(
+                    select([table.c.id, table.c.payload])
+                    .where(table.c.id > last)
+                    .order_by(table.c.id)).fetchall()
+                for id, payload in rows:
+                    last = id
+                    deliver(payload)
+
+                polls += 1
+                if polls * self.interval >= self.prune_every:
+                    # everything below the previous mark has been seen by every running process
+                    # the newest row is always kept, SQLite reuses the ids of deleted rows at the top of the table
+                    # and processes would skip new rows until the ids passed what they had seen
+                    newest = select([func.max(table.c.id)]).as_scalar()
+                    self.engine.execute(table.delete().where(and_(table.c.id <= prune_below, table.c.id < newest)))
+                    prune_below = last
+                    polls = 0
+            except Exception:
+                logger.exception('Could not poll for changes')
+                changes.reset()
+
+
+def setup(engine, loop, interval=2):
+    '''
+    Starts publishing and receiving changes
+    Changes from other processes are applied within interval seconds
+    '''
+    global transport
+    if engine.dialect.name == 'postgresql':
+        transport = PostgresTransport(engine, interval)
+    else:
+        transport = PollingTransport(engine, interval)
+    loop.create_task(transport.listen(loop))
+    return transport
+
+
+@event.listens_for(Session, 'before_commit')
+def before_commit(session):
+    if transport is None:
+        return
+    session.flush()
+    pending = session.info.get('changes')
+    if pending:
+        for payload in payloads(pending):
+            transport.publish(session, payload)
@@ -0,0 +1,191 @@
+'''
+Random number sources for dice and tables
+
+Uniform integers are drawn ahead of time into a buffer per range,
+buffers running low are refilled by the event loop between commands
+Servers can choose a source with the `setrandom` command:
+    default: the Mersenne Twister from the random module
+    secure: the operating system's randomness, as used by the secrets module
+A seeded source can replace every server's source for tests and benchmarks
+'''
+
+import random
+import asyncio
+import secrets
+from collections import deque
+from contextlib import closing
+
+from . import model as m
+from . import changes
+
+
+class BufferedRandom:
+    '''
+    Draws uniform integers from a random.Random instance in batches
+    '''
+    # the number of values drawn at a time for a range
+    size = 1024
+    # buffers with fewer values left are refilled in the background
+    low = 128
+    # the number of ranges that get buffers, other ranges are drawn directly
+    ranges = 64
+
+    def __init__(self, source):
+        self.source = source
+        self.buffers = {}
+        self.scheduled = set()
+
+    def generator(self, a, b):
+        '''
+        Gets the random.Random instance values in a range are drawn from
+        '''
+        return self.source
+
+    def draw(self, count, a, b):
+        '''
+        Draws count new values in a range
+        '''
+        return self.generator(a, b).choices(range(a, b + 1), k=count)
+
+    def fill(self, key, count=0):
+        '''
+        Tops up the buffer for a range so it holds at least count values
+        '''
+        self.scheduled.discard(key)
+        buffer = self.buffers[key]
+        if len(buffer) < max(count, self.low):
+            buffer.extend(self.draw(max(count, self.size), *key))
+
+    def schedule(self, key):
+        if key in self.scheduled:
+            return
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            return
+        if loop.is_running():
+            self.scheduled.add(key)
+            loop.call_soon(self.fill, key)
+
+    def randints(self, count, a, b):
+        '''
+        Gets a list of count random integers N such that a <= N <= b
+        '''
+        key = (a, b)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            if len(self.buffers) >= self.ranges:
+                return self.draw(count, a, b)
+            buffer = self.buffers[key] = deque()
+        if len(buffer) < count:
+            self.fill(key, count)
+        values = [buffer.popleft() for _ in range(count)]
+        if len(buffer) < self.low:
+            self.schedule(key)
+        return values
+
+    def randint(self, a, b):
+        '''
+        Gets a random integer N such that a <= N <= b
+        '''
+        return self.randints(1, a, b)[0]
+
+    def choice(self, seq):
+        '''
+        Gets a random element from a non-empty sequence
+        '''
+        return seq[self.randint(0, len(seq) - 1)]
+
+
+class SecureRandom (BufferedRandom):
+    '''
+    Draws from the operating system's randomness
+    Values are drawn with randbelow like the secrets module,
+    choices scales a float to the range which makes some values slightly more likely
+    '''
+    def __init__(self):
+        super().__init__(random.SystemRandom())
+
+    def draw(self, count, a, b):
+        n = b - a + 1
+        return [a + secrets.randbelow(n) for _ in range(count)]
+
+
+class SeededRandom (BufferedRandom):
+    '''
+    Deterministic source for tests and benchmarks
+    Each range has its own generator so the values do not depend on when buffers are refilled
+    '''
+    ranges = float('inf')
+
+    def __init__(self, seed):
+        super().__init__(None)
+        self.seed = seed
+        self.generators = {}
+
+    def generator(self, a, b):
+        key = (a, b)
+        generator = self.generators.get(key)
+        if generator is None:
+            generator = self.generators[key] = random.Random('{}:{}:{}'.format(self.seed, a, b))
+        return generator
+
+
+sources = {
+    'default': BufferedRandom(random.Random()),
+    'secure': SecureRandom(),
+}
+
+# the source chosen by each server that does not use the default
+servers = {}
+
+# replaces every server's source when set
+override = None
+
+session_factory = None
+
+
+def get(server=None):
+    '''
+    Gets the random source for a server
+    '''
+    if override is not None:
+        return override
+    return sources.get(servers.get(str(server)), sources['default'])
+
+
+def seed(value):
+    '''
+    Makes every source deterministic, None restores the normal sources
+    '''
+    global override
+    override = None if value is None else SeededRandom(value)
+
+
+def load(Session):
+    '''
+    Loads the servers' chosen sources
+    [Session] the session factory, kept to reload the sources after a reset
+    '''
+    global session_factory
+    session_factory = Session
+    with closing(Session()) as session:
+        choices = session.query(m.RandomSource.server, m.RandomSource.source).all()
+    servers.clear()
+    servers.update(choices)
+
+
+@changes.subscribe
+def apply(committed):
+    for change in committed:
+        if change.table == m.RandomSource.__tablename__:
+            if change.new is None:
+                servers.pop(change.key, None)
+            else:
+                servers[change.key] = change.new
+
+
+@changes.on_reset
+def reset():
+    if session_factory is not None:
+        load(session_factory)
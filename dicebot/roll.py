@@ -0,0 +1,189 @@
+'''
+Rolls dice expressions without connecting to discord, for scripts and tests
+
+Reads one expression per line from a file or stdin and writes one JSON object per line to stdout,
+in the same order as the input:
+    {"line": 1, "expression": "2d6+3", "result": 10, "output": ["`2d6+3`", "2d6: 3 + 4 = 7", "You rolled 10"]}
+    {"line": 2, "expression": "2d", "error": "Not enough operands for d in 2d"}
+Blank lines and lines starting with # are skipped
+Rolls made for a character are not added to its history or statistics
+
+Input is read and evaluated in batches as it arrives, so the input can be longer than fits in memory
+With more than one worker, batches are rolled in parallel worker processes
+With a seed, each batch gets its own seeded source so the results don't depend on the number of workers
+
+Usage:
+    python -m dicebot.roll [file] [--character NAME --server ID [--database URL]] [--workers N] [--seed SEED]
+The database defaults to the DB environment variable, like dice-bot.py
+'''
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+from collections import deque, namedtuple
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from . import rng
+from .cogs import repository
+from .cogs.rolls import do_roll
+
+
+class Character (namedtuple('Character', ['id', 'name', 'server', 'rolls', 'variables'])):
+    '''
+    The parts of a character that rolls use, copied out of the database so they can be sent to workers
+    '''
+    def __str__(self):
+        return str(self.name)
+
+
+Roll = namedtuple('Roll', ['name', 'expression', 'compiled'])
+Variable = namedtuple('Variable', ['name', 'value'])
+
+# the character and seed used by the process, set by setup
+character = None
+seed = None
+
+
+def load_character(database, server, name):
+    '''
+    Copies a character's rolls and variables from the database
+    '''
+    engine = create_engine(database)
+    with closing(sessionmaker(bind=engine)()) as session:
+        found = repository.get_named_character(session, name, server)
+        if found is None:
+            raise Exception('No character named {} on server {}'.format(name, server))
+        loaded = Character(
+            found.id, found.name, found.server,
+            tuple(Roll(roll.name, roll.expression, roll.compiled) for roll in found.rolls),
+            tuple(Variable(variable.name, variable.value) for variable in found.variables))
+    engine.dispose()
+    return loaded
+
+
+def setup(roll_character, roll_seed, worker=False):
+    '''
+    Sets the character and seed for the expressions rolled by this process
+    [worker] whether this is a worker process, forked with a copy of the parent's random state
+    '''
+    global character, seed
+    character = roll_character
+    seed = roll_seed
+    if worker:
+        for source in rng.sources.values():
+            source.buffers.clear()
+            source.source.seed()
+
+
+def batches(lines, size):
+    '''
+    Groups the expressions in a stream of lines into lists of (line number, expression)
+    '''
+    batch = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        batch.append((number, line))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def evaluate(batch):
+    results = []
+    for number, expression in batch:
+        result = {'line': number, 'expression': expression}
+        try:
+            output = []
+            # nothing writes the history and statistics buffers in this process
+            roll = await do_roll(expression, None, character, output=[], detail=output, record=False)
+            result['result'] = roll
+            result['output'] = output
+        except Exception as e:
+            result['error'] = str(e).strip()
+        results.append(json.dumps(result))
+    return results
+
+
+def evaluate_batch(index, batch):
+    '''
+    Rolls a batch of expressions
+    [index] the position of the batch in the input, seeds the batch's source
+    Returns the results as JSON lines
+    '''
+    if seed is not None:
+        rng.seed('{}:{}'.format(seed, index))
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(evaluate(batch))
+    finally:
+        loop.close()
+
+
+def write(results, out):
+    for result in results:
+        out.write(result)
+        out.write('\n')
+
+
+def run(lines, out, roll_character=None, roll_seed=None, workers=1, batch_size=256):
+    '''
+    Rolls every expression in a stream of lines and writes the results to out
+    At most two batches per worker are in flight at once, so memory use doesn't grow with the input
+    '''
+    if workers <= 1:
+        setup(roll_character, roll_seed)
+        for index, batch in enumerate(batches(lines, batch_size)):
+            write(evaluate_batch(index, batch), out)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=setup, initargs=(roll_character, roll_seed, True)) as executor:
+        pending = deque()
+        for index, batch in enumerate(batches(lines, batch_size)):
+            pending.append(executor.submit(evaluate_batch, index, batch))
+            if len(pending) >= workers * 2:
+                write(pending.popleft().result(), out)
+        while pending:
+            write(pending.popleft().result(), out)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m dicebot.roll',
+        description='Rolls dice expressions, one per line, and writes the results as JSON lines')
+    parser.add_argument('file', nargs='?', help='the file to read expressions from, stdin if not given')
+    parser.add_argument('--database', default=os.environ.get('DB'), help='the database url, defaults to $DB')
+    parser.add_argument('--server', help='the id of the server of the character')
+    parser.add_argument('--character', help="the name of a character whose rolls and variables to use")
+    parser.add_argument('--workers', type=int, default=1, help='the number of worker processes')
+    parser.add_argument('--batch', type=int, default=256, help='the number of expressions sent to a worker at once')
+    parser.add_argument('--seed', help='makes the results repeatable')
+    args = parser.parse_args(args)
+
+    roll_character = None
+    if args.character is not None:
+        if args.database is None or args.server is None:
+            parser.error('--character needs --server and a database')
+        roll_character = load_character(args.database, args.server, args.character)
+
+    if args.batch < 1:
+        parser.error('--batch must be at least 1')
+
+    if args.file is None:
+        run(sys.stdin, sys.stdout, roll_character, args.seed, args.workers, args.batch)
+    else:
+        with open(args.file) as lines:
+            run(lines, sys.stdout, roll_character, args.seed, args.workers, args.batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Full text search over spell and information descriptions
+
+SQLite uses an external content FTS5 table per searchable table kept up to date by triggers
+PostgreSQL uses a GIN index over the tsvector of the name and description
+Other databases fall back to substring matching
+'''
+
+import re
+
+from sqlalchemy import func, literal_column, or_
+from sqlalchemy.sql import table as table_clause, column
+from sqlalchemy.exc import OperationalError
+
+from . import model as m
+
+searchable = [m.Spell, m.Information]
+
+# tables that have a working full text index, filled in by setup
+indexed = set()
+
+sqlite_statements = [
+    '''
+    CREATE VIRTUAL TABLE {0}_search USING fts5(
+        name, description, content='{0}', content_rowid='id')
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS {0}_search_insert AFTER INSERT ON {0} BEGIN
+        INSERT INTO {0}_search(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS {0}_search_delete AFTER DELETE ON {0} BEGIN
+        INSERT INTO {0}_search({0}_search, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS {0}_search_update AFTER UPDATE OF name, description ON {0} BEGIN
+        INSERT INTO {0}_search({0}_search, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO {0}_search(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    ''',
+    '''
+    INSERT INTO {0}_search({0}_search) VALUES ('rebuild')
+    ''',
+]
+
+postgresql_document = "to_tsvector('english', coalesce({0}.name, '') || ' ' || coalesce({0}.description, ''))"
+
+postgresql_statements = [
+    '''
+    CREATE INDEX IF NOT EXISTS _{0}_search_index ON {0} USING GIN ({1})
+    ''',
+]
+
+
+def setup(engine, create=True):
+    '''
+    Finds the full text indexes that exist and creates the ones that do not exist yet
+    [create] whether to create missing indexes, False only looks for existing ones
+    '''
+    indexed.clear()
+    with engine.begin() as connection:
+        for type in searchable:
+            table = type.__tablename__
+            if engine.dialect.name == 'sqlite':
+                exists = connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                    (table + '_search',)).scalar()
+                if not exists:
+                    if not create:
+                        continue
+                    try:
+                        for statement in sqlite_statements:
+                            connection.execute(statement.format(table))
+                    except OperationalError:
+                        # SQLite was built without FTS5
+                        continue
+                indexed.add(table)
+            elif engine.dialect.name == 'postgresql':
+                if create:
+                    for statement in postgresql_statements:
+                        connection.execute(statement.format(table, postgresql_document.format(table)))
+                else:
+                    exists = connection.execute(
+                        'SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                        ('_{}_search_index'.format(table),)).scalar()
+                    if not exists:
+                        continue
+                indexed.add(table)
+
+
+def search(session, type, character, query, limit=10, offset=0):
+    '''
+    Searches the names and descriptions of a character's spells or information
+    Returns the matching items, best matches first
+    '''
+    table = type.__tablename__
+    words = re.findall(r'\w+', query)
+    if not words:
+        return []
+
+    items = session.query(type).filter(type.character_id == character.id)
+    dialect = session.bind.dialect.name
+    if table in indexed and dialect == 'sqlite':
+        # quote each word so user input can't use the FTS5 query syntax, allow prefix matches on the last
+        match = ' '.join('"{}"'.format(word) for word in words) + '*'
+        index = table_clause(table + '_search', column('rowid'), column('rank'))
+        items = items\
+            .join(index, index.c.rowid == type.id)\
+            .filter(literal_column(index.name).op('MATCH')(match))\
+            .order_by(index.c.rank, type.name)
+    elif table in indexed and dialect == 'postgresql':
+        document = literal_column(postgresql_document.format(table))
+        tsquery = func.plainto_tsquery('english', ' '.join(words))
+        items = items\
+            .filter(document.op('@@')(tsquery))\
+            .order_by(func.ts_rank(document, tsquery).desc(), type.name)
+    else:
+        for word in words:
+            pattern = '%{}%'.format(word)
+            items = items.filter(or_(type.name.ilike(pattern), type.description.ilike(pattern)))
+        items = items.order_by(type.name)
+
+    return items.limit(limit).offset(offset).all()
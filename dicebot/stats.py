@@ -0,0 +1,142 @@
+'''
+Running statistics of the dice each character rolls
+
+do_roll passes the faces of every die to `tally.record`,
+they are merged in memory and added to the roll_stats table in batches by a background task
+Each row keeps the count, sum, sum of squares and face histogram of one die size,
+so checking whether a die is fair never has to look at individual rolls
+'''
+
+import json
+import math
+import asyncio
+import logging
+from collections import Counter
+from contextlib import closing
+
+from . import model as m
+
+logger = logging.getLogger(__name__)
+
+# dice with more sides only keep the count and sums, not the histogram
+histogram_sides = 100
+
+
+class Tally:
+    '''
+    Collects faces rolled since the last write
+    '''
+    def __init__(self):
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def record(self, character_id, sides, faces):
+        '''
+        Adds the faces of dice with the same number of sides rolled by a character
+        '''
+        if sides < 1 or not faces:
+            return
+        key = (character_id, sides)
+        counts = self.pending.get(key)
+        if counts is None:
+            counts = self.pending[key] = Counter()
+        counts.update(faces)
+
+    def faces(self, character_id, sides):
+        '''
+        Gets the faces of one die size a character rolled that are not written yet
+        '''
+        return self.pending.get((character_id, sides), Counter())
+
+    def flush(self, session):
+        '''
+        Adds everything collected to the database in one transaction
+        '''
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = {}
+        try:
+            rows = session.query(m.RollStats)\
+                .filter(m.RollStats.character_id.in_({key[0] for key in pending}))\
+                .with_for_update().all()
+            rows = {(row.character_id, row.sides): row for row in rows}
+            for key, counts in pending.items():
+                row = rows.get(key)
+                if row is None:
+                    character_id, sides = key
+                    row = m.RollStats(character_id=character_id, sides=sides, count=0, total=0, squares=0)
+                    if sides <= histogram_sides:
+                        row.histogram = json.dumps([0] * sides)
+                    session.add(row)
+                merge(row, counts)
+            session.commit()
+        except Exception:
+            session.rollback()
+            # keep the faces for the next attempt
+            for key, counts in pending.items():
+                self.pending.setdefault(key, Counter()).update(counts)
+            raise
+
+    async def run(self, Session, interval=5):
+        '''
+        Writes the collected faces every interval seconds
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                with closing(Session()) as session:
+                    self.flush(session)
+            except Exception:
+                logger.exception('Could not write roll statistics')
+
+
+def combined(row, counts, sides):
+    '''
+    Adds a Counter of faces to the totals of a statistics row without changing it
+    [row] the row, None if nothing has been written for the die size
+    Returns the count, sum, sum of squares and histogram, the histogram is None for large dice
+    '''
+    count = sum(counts.values())
+    total = sum(face * n for face, n in counts.items())
+    squares = sum(face * face * n for face, n in counts.items())
+    histogram = [0] * sides if sides <= histogram_sides else None
+    if row is not None:
+        count += row.count
+        total += row.total
+        squares += row.squares
+        histogram = json.loads(row.histogram) if row.histogram is not None else None
+    if histogram is not None:
+        for face, n in counts.items():
+            histogram[face - 1] += n
+    return count, total, squares, histogram
+
+
+def merge(row, counts):
+    '''
+    Adds a Counter of faces to a statistics row
+    '''
+    row.count, row.total, row.squares, histogram = combined(row, counts, row.sides)
+    if histogram is not None:
+        row.histogram = json.dumps(histogram)
+
+
+def fairness(histogram):
+    '''
+    Pearson's chi-square test that every face is equally likely
+    Returns the statistic and its p-value, using the Wilson-Hilferty approximation of the distribution
+    '''
+    count = sum(histogram)
+    df = len(histogram) - 1
+    expected = count / len(histogram)
+    chi2 = sum((n - expected) ** 2 for n in histogram) / expected
+    # (chi2 / df) ** (1/3) is close to normal with this mean and variance
+    variance = 2 / (9 * df)
+    z = ((chi2 / df) ** (1 / 3) - (1 - variance)) / math.sqrt(variance)
+    p = 0.5 * math.erfc(z / math.sqrt(2))
+    return chi2, p
+
+
+tally = Tally()